@@ -0,0 +1,464 @@
+"""
+Offline benchmark of Teachable-dl against a local mock of the Teachable and Hotmart pages.
+
+The mock server imitates the three supported course templates, lecture pages with embed-player iframes, the
+__NEXT_DATA__ of the player, HLS playlists with synthetic segments, VTT subtitles and attachments, so a whole
+course can be downloaded without any network access. The timings of every phase are collected with the
+performance report of the downloader.
+
+    python3 benchmark.py --lectures 20 --workers 4 --report bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import main
+
+TEMPLATES = ["next", "mainbar", "block"]
+
+# MPEG-TS null packet, used as segment payload when ffmpeg can not generate a real test video
+NULL_TS_PACKET = b"\x47\x1f\xff\x10" + b"\xff" * 184
+
+
+class MockCourse:
+    """
+    Generates the pages of a mock course of the given size, for every supported template.
+    """
+
+    def __init__(self, sections=2, lectures=10, attachments=1, attachment_size=256 * 1024, segments=4,
+                 segment_size=256 * 1024, subtitle_languages=("en",), subtitle_segments=1, media_dir=None):
+        self.sections = sections
+        self.lectures = lectures
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.segments = segments
+        self.segment_size = segment_size
+        self.subtitle_languages = list(subtitle_languages)
+        self.subtitle_segments = subtitle_segments
+        self.media_dir = media_dir
+        self.segment_payload = NULL_TS_PACKET * max(1, segment_size // len(NULL_TS_PACKET))
+        self.attachment_payload = os.urandom(attachment_size)
+
+    def course_title(self, template):
+        return "Benchmark Course " + template
+
+    def curriculum(self, template):
+        # Spread the lectures over the sections, lecture ids are unique across the templates
+        template_offset = TEMPLATES.index(template) * 100000
+        curriculum = []
+        lecture_id = template_offset
+        per_section = max(1, -(-self.lectures // self.sections))
+        for section_idx in range(self.sections):
+            lectures = []
+            for _ in range(per_section):
+                if lecture_id - template_offset >= self.lectures:
+                    break
+                lecture_id += 1
+                title = "Lecture {} of section {}".format(lecture_id - template_offset, section_idx + 1)
+                lectures.append({"id": lecture_id, "title": title})
+            curriculum.append({"title": "Section {}".format(section_idx + 1), "lectures": lectures})
+        return curriculum
+
+    def lecture_link(self, template, lecture_id):
+        return "/courses/{}/lectures/{}".format(template, lecture_id)
+
+    def course_page(self, template):
+        title = self.course_title(template)
+        if template == "next":
+            sections = "".join(
+                '<div class="slim-section"><h3 class="heading">{}</h3>{}</div>'.format(section["title"], "".join(
+                    '<div class="bar"><a class="text" href="{}">{}</a></div>'.format(
+                        self.lecture_link(template, lecture["id"]), lecture["title"])
+                    for lecture in section["lectures"]))
+                for section in self.curriculum(template))
+            return ('<html><head><title>{title}</title></head><body><div id="__next"><div class="wrap"><div>'
+                    '<div><h1 class="heading">{title}</h1></div>'
+                    '<div><div><div><img src="/images/course.jpg"></div></div></div>'
+                    '</div>{sections}</div></div></body></html>').format(title=title, sections=sections)
+
+        if template == "mainbar":
+            sections = "".join(
+                '<div class="course-section"><div class="section-title">{}</div><ul>{}</ul></div>'.format(
+                    section["title"], "".join(
+                        '<li class="section-item"><a class="item" href="{}"><span class="lecture-name">{}</span>'
+                        '</a></li>'.format(self.lecture_link(template, lecture["id"]), lecture["title"])
+                        for lecture in section["lectures"]))
+                for section in self.curriculum(template))
+            return ('<html><head><title>{title}</title></head><body><section>'
+                    '<div class="course-sidebar"><div><img class="course-image" src="/images/course.jpg">'
+                    '<h2>{title}</h2></div></div>'
+                    '<div class="course-mainbar">{sections}</div></section></body></html>').format(
+                title=title, sections=sections)
+
+        sections = "".join(
+            '<div class="block__curriculum__section"><h3 class="block__curriculum__section__title">{}</h3>'
+            '<ul>{}</ul></div>'.format(section["title"], "".join(
+                '<li><a class="block__curriculum__section__list__item__link" href="{}">'
+                '<span class="block__curriculum__section__list__item__lecture-name">{}</span></a></li>'.format(
+                    self.lecture_link(template, lecture["id"]), lecture["title"])
+                for lecture in section["lectures"]))
+            for section in self.curriculum(template))
+        return ('<html><head><title>{title}</title></head><body><h1 class="course__title">{title}</h1>'
+                '<div class="block__curriculum">{sections}</div></body></html>').format(title=title,
+                                                                                      sections=sections)
+
+    def lecture_page(self, template, lecture_id):
+        attachments = "".join(
+            '<a class="download" href="/attachments/{id}/{idx}">lecture-{id}-attachment-{idx}.pdf</a>'.format(
+                id=lecture_id, idx=idx) for idx in range(self.attachments))
+        return ('<html><head><title>Lecture {id}</title><meta name="csrf-token" content="benchmark-token"></head>'
+                '<body><h2 id="lecture_heading">Lecture {id}</h2>'
+                '<div class="lecture-attachment lecture-attachment-type-file">{attachments}</div>'
+                '<div class="hotmart-player"><iframe data-testid="embed-player-{id}" src="/embed/{id}"></iframe>'
+                '</div><div id="lecture_complete_button" data-course-id="{template}" data-lecture-id="{id}">'
+                'Complete and continue</div></body></html>').format(id=lecture_id, template=template,
+                                                                    attachments=attachments)
+
+    def embed_page(self, base_url, lecture_id):
+        next_data = {"props": {"pageProps": {"applicationData": {"mediaAssets": [
+            {"urlEncrypted": "{}/hls/{}/master.m3u8".format(base_url, lecture_id)}]}}}}
+        return ('<html><body><div id="player"></div><script id="__NEXT_DATA__" type="application/json">{}</script>'
+                '</body></html>').format(json.dumps(next_data))
+
+    def master_playlist(self):
+        lines = ["#EXTM3U"]
+        for lang in self.subtitle_languages:
+            lines.append('#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",NAME="{0}",LANGUAGE="{0}",AUTOSELECT=YES,'
+                         'DEFAULT=NO,URI="subs/{0}.m3u8"'.format(lang))
+        lines.append('#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360{}'.format(
+            ',SUBTITLES="subs"' if self.subtitle_languages else ""))
+        lines.append("video.m3u8")
+        return "\n".join(lines) + "\n"
+
+    def media_playlist(self, name_format, count, duration):
+        lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:{}".format(duration), "#EXT-X-VERSION:3",
+                 "#EXT-X-MEDIA-SEQUENCE:0"]
+        for idx in range(count):
+            lines.append("#EXTINF:{:.1f},".format(duration))
+            lines.append(name_format.format(idx))
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def video_playlist(self):
+        if self.media_dir:
+            with open(os.path.join(self.media_dir, "video.m3u8"), "r", encoding="utf-8") as f:
+                return f.read()
+        return self.media_playlist("seg{}.ts", self.segments, 6)
+
+    def segment(self, idx):
+        if self.media_dir:
+            with open(os.path.join(self.media_dir, "seg{}.ts".format(idx)), "rb") as f:
+                return f.read()
+        return self.segment_payload
+
+    def subtitle_segment(self, lang, idx):
+        start = idx * 6
+        return ("WEBVTT\n\n00:00:{:02d}.000 --> 00:00:{:02d}.000\nBenchmark subtitle {} {}\n".format(
+            start % 60, (start + 5) % 60, lang, idx)).encode("utf-8")
+
+
+def create_media(media_dir, segments):
+    """
+    Generates a real HLS test video with ffmpeg, so the postprocessing phases work on valid media.
+
+    :param media_dir: str
+        The folder the playlist and segments are written to.
+    :param segments: int
+        The number of 6 seconds segments.
+    :return: bool
+        True if the test video was generated, False if ffmpeg is not available or failed.
+    """
+    if not shutil.which("ffmpeg"):
+        return False
+    duration = segments * 6
+    command = ["ffmpeg", "-y", "-v", "error", "-f", "lavfi", "-i",
+               "testsrc=duration={}:size=640x360:rate=25".format(duration), "-f", "lavfi", "-i",
+               "sine=frequency=440:duration={}".format(duration), "-c:v", "libx264", "-preset", "ultrafast",
+               "-c:a", "aac", "-f", "hls", "-hls_time", "6", "-hls_list_size", "0",
+               "-hls_segment_filename", os.path.join(media_dir, "seg%d.ts"), os.path.join(media_dir, "video.m3u8")]
+    try:
+        subprocess.run(command, check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warning("Could not generate the test video: " + str(e))
+        return False
+    return True
+
+
+def make_handler(course):
+    class MockCourseHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.debug("Mock server: " + format % args)
+
+        def send_body(self, body, content_type, headers=None):
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(body)
+
+        def send_not_found(self):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_HEAD(self):
+            self.do_GET()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            self.rfile.read(length)
+            if self.path.startswith("/api/v1/courses/") and self.path.endswith("/complete"):
+                self.send_body("{}", "application/json")
+            else:
+                self.send_not_found()
+
+        def do_GET(self):
+            base_url = "http://" + self.headers.get("Host", "127.0.0.1")
+            parts = urlparse(self.path).path.strip("/").split("/")
+            try:
+                if parts[0] == "courses" and len(parts) == 2 and parts[1] in TEMPLATES:
+                    self.send_body(course.course_page(parts[1]), "text/html; charset=utf-8")
+                elif parts[0] == "courses" and len(parts) == 4 and parts[2] == "lectures":
+                    self.send_body(course.lecture_page(parts[1], int(parts[3])), "text/html; charset=utf-8")
+                elif parts[0] == "embed" and len(parts) == 2:
+                    self.send_body(course.embed_page(base_url, int(parts[1])), "text/html; charset=utf-8")
+                elif parts[0] == "hls" and parts[2:] == ["master.m3u8"]:
+                    self.send_body(course.master_playlist(), "application/vnd.apple.mpegurl")
+                elif parts[0] == "hls" and parts[2:] == ["video.m3u8"]:
+                    self.send_body(course.video_playlist(), "application/vnd.apple.mpegurl")
+                elif parts[0] == "hls" and len(parts) == 3 and parts[2].startswith("seg"):
+                    self.send_body(course.segment(int(parts[2][3:].split(".")[0])), "video/mp2t")
+                elif parts[0] == "hls" and len(parts) == 4 and parts[2] == "subs" and parts[3].endswith(".m3u8"):
+                    lang = parts[3][:-len(".m3u8")]
+                    self.send_body(course.media_playlist(lang + "/{}.vtt", course.subtitle_segments, 6),
+                                   "application/vnd.apple.mpegurl")
+                elif parts[0] == "hls" and len(parts) == 5 and parts[2] == "subs":
+                    self.send_body(course.subtitle_segment(parts[3], int(parts[4].split(".")[0])), "text/vtt")
+                elif parts[0] == "attachments" and len(parts) == 3:
+                    file_name = "lecture-{}-attachment-{}.pdf".format(parts[1], parts[2])
+                    self.send_body(course.attachment_payload, "application/pdf",
+                                   {"Content-Disposition": 'attachment; filename="' + file_name + '"'})
+                elif parts[0] == "images":
+                    self.send_body(course.attachment_payload[:16 * 1024], "image/jpeg")
+                else:
+                    self.send_not_found()
+            except (ValueError, IndexError):
+                self.send_not_found()
+
+    return MockCourseHandler
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping their keep-alive connections are expected
+        logging.debug("Mock server: connection error from " + str(client_address) + ": " + str(sys.exc_info()[1]))
+
+
+class MockCourseServer:
+    """
+    Serves a MockCourse on a local port from a background thread.
+    """
+
+    def __init__(self, course, port=0):
+        self.server = QuietHTTPServer(("127.0.0.1", port), make_handler(course))
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-server", daemon=True)
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def benchmark_parsers(course, perf, iterations):
+    # Times the curriculum parsers on the generated pages, without a browser, returns False if one of them missed
+    # lectures
+    passed = True
+    parsers = {"next": main.parse_curriculum_simple, "mainbar": main.parse_curriculum_classic,
+               "block": main.parse_curriculum_colossal}
+    for template in TEMPLATES:
+        page_source = course.course_page(template)
+        for _ in range(iterations):
+            with perf.span("parse_" + template, template) as span:
+                sections = parsers[template](page_source, "http://127.0.0.1/courses/" + template)
+                span["bytes"] = len(page_source)
+        lectures = sum(len(section["lectures"]) for section in sections)
+        if lectures != course.lectures:
+            logging.error("Parser of the " + template + " template found " + str(lectures) + " lectures instead of "
+                          + str(course.lectures))
+            passed = False
+    return passed
+
+
+def benchmark_downloads(server, perf, templates, args):
+    downloader = main.TeachableDownloader(verbose_arg=args.verbose > 1, complete_lecture_arg=args.complete_lecture,
+                                          user_agent_arg=args.user_agent, timeout_arg=args.timeout,
+                                          workers_arg=args.workers, http_resolve_arg=args.http_resolve,
+                                          fast_remux_arg=args.fast_remux,
+                                          postprocess_workers_arg=args.postprocess_workers,
+                                          headless_arg=not args.headed, perf_arg=perf)
+    try:
+        for template in templates:
+            course_url = server.base_url + "/courses/" + template
+            with perf.span("course", template):
+                downloader.driver.get(course_url)
+                downloader.pick_course_downloader(course_url)
+    finally:
+        downloader.clean_up()
+
+
+def check_output(output_dir, course, templates):
+    # Counts what the run left on disk, so a fast run that downloaded nothing does not pass unnoticed, returns False
+    # if anything is missing
+    counts = {"html": 0, "attachments": 0, "videos": 0, "subtitles": 0}
+    for template in templates:
+        course_path = os.path.join(output_dir, "courses", main.clean_string(course.course_title(template)))
+        for root, dirs, files in os.walk(course_path):
+            # Skip the unprocessed downloads and the blob store
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for file_name in files:
+                if file_name.endswith(".pdf"):
+                    counts["attachments"] += 1
+                elif file_name.endswith(".vtt"):
+                    counts["subtitles"] += 1
+                elif file_name.endswith(".html") and file_name != "course.html":
+                    counts["html"] += 1
+                elif file_name.endswith((".mp4", ".ts", ".mkv")):
+                    counts["videos"] += 1
+    lectures = course.lectures * len(templates)
+    logging.info("Downloaded {html} lecture pages, {videos} videos, {subtitles} subtitles and {attachments} "
+                 "attachments".format(**counts))
+    expected = {"html": lectures, "attachments": lectures * course.attachments,
+                "subtitles": lectures * len(course.subtitle_languages)}
+    if course.media_dir:
+        # The synthetic segments can not be postprocessed, videos are only expected from real media
+        expected["videos"] = lectures
+    passed = True
+    for kind, count in expected.items():
+        if counts[kind] != count:
+            logging.error("Expected " + str(count) + " " + kind + ", found " + str(counts[kind]))
+            passed = False
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='Teachable-Dl benchmark',
+                                     description='Benchmark the downloader against a local mock course')
+    parser.add_argument("--templates", nargs="+", choices=TEMPLATES, default=TEMPLATES,
+                        help='Course templates to benchmark (default: all)')
+    parser.add_argument("--sections", type=int, default=2, help='Number of sections per course (default: 2)')
+    parser.add_argument("--lectures", type=int, default=10, help='Number of lectures per course (default: 10)')
+    parser.add_argument("--attachments", type=int, default=1, help='Number of attachments per lecture (default: 1)')
+    parser.add_argument("--attachment-size", type=int, default=256 * 1024,
+                        help='Size of every attachment in bytes (default: 262144)')
+    parser.add_argument("--segments", type=int, default=4, help='Number of HLS segments per video (default: 4)')
+    parser.add_argument("--segment-size", type=int, default=256 * 1024,
+                        help='Size of the synthetic HLS segments in bytes, when ffmpeg is not available '
+                             '(default: 262144)')
+    parser.add_argument("--subtitles", nargs="*", default=["en"],
+                        help='Subtitle languages of every video (default: en)')
+    parser.add_argument("--subtitle-segments", type=int, default=1,
+                        help='Number of VTT segments per subtitle playlist (default: 1)')
+    parser.add_argument("--parse-only", action='store_true', default=False,
+                        help='Only benchmark the curriculum parsers, without a browser')
+    parser.add_argument("--parse-iterations", type=int, default=20,
+                        help='Number of times every curriculum parser runs (default: 20)')
+    parser.add_argument("--port", type=int, default=0, help='Port of the mock server (default: any free port)')
+    parser.add_argument("--output", required=False,
+                        help='Folder the courses are downloaded to (default: a temporary folder that is removed)')
+    parser.add_argument("--report", required=False, help='Write the timings to this file (.json or .csv)')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='Increase verbosity level (repeat for more verbosity)')
+    parser.add_argument('--complete-lecture', action='store_true', default=False,
+                        help='Complete the lectures after downloading')
+    parser.add_argument("--user-agent", required=False, help='User agent to use when downloading videos',
+                        default="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                                "Chrome/116.0.0.0 Safari/537.36")
+    parser.add_argument("-t", "--timeout", type=int, default=10, help='Timeout for selenium driver')
+    parser.add_argument("-w", "--workers", type=int, default=0, help='Number of download workers (default: 0)')
+    parser.add_argument("--http-resolve", action='store_true', default=False,
+                        help='Resolve lectures over http with the browser cookies')
+    parser.add_argument("--fast-remux", action='store_true', default=False,
+                        help='Remux the videos in a single ffmpeg pass on a separate pool')
+    parser.add_argument("--postprocess-workers", type=int, default=2,
+                        help='Number of parallel ffmpeg postprocessing jobs when using --fast-remux (default: 2)')
+    parser.add_argument("--headed", action='store_true', default=False,
+                        help='Run the browser headed instead of with the headless crawl profile')
+    args = parser.parse_args()
+
+    if args.verbose == 0:
+        log_level = logging.WARNING
+    elif args.verbose == 1:
+        log_level = logging.INFO
+    else:
+        log_level = logging.DEBUG
+    logging.basicConfig(level=log_level, format='%(levelname)s: %(message)s')
+
+    work_dir = tempfile.mkdtemp(prefix="teachable-dl-benchmark-")
+    output_dir = os.path.abspath(args.output) if args.output else os.path.join(work_dir, "output")
+    media_dir = os.path.join(work_dir, "media")
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(media_dir, exist_ok=True)
+
+    if args.parse_only or not create_media(media_dir, args.segments):
+        media_dir = None
+        if not args.parse_only:
+            logging.warning("ffmpeg not found, serving synthetic segments, the postprocessing of the videos fails")
+
+    course = MockCourse(sections=args.sections, lectures=args.lectures, attachments=args.attachments,
+                        attachment_size=args.attachment_size, segments=args.segments,
+                        segment_size=args.segment_size, subtitle_languages=args.subtitles,
+                        subtitle_segments=args.subtitle_segments, media_dir=media_dir)
+    perf = main.PerformanceReport()
+    exit_code = 0
+    cwd = os.getcwd()
+    try:
+        if not benchmark_parsers(course, perf, args.parse_iterations):
+            exit_code = 1
+        if not args.parse_only:
+            with MockCourseServer(course, args.port) as server:
+                logging.info("Mock server listening on " + server.base_url)
+                # The downloader writes the courses into the working directory
+                os.chdir(output_dir)
+                start = time.perf_counter()
+                benchmark_downloads(server, perf, args.templates, args)
+                perf.record("total", "", time.perf_counter() - start)
+            if not check_output(output_dir, course, args.templates):
+                exit_code = 1
+    except KeyboardInterrupt:
+        logging.error("Interrupted by user")
+        exit_code = 1
+    except Exception as e:
+        logging.error("Benchmark failed: " + str(e), exc_info=args.verbose > 1)
+        exit_code = 1
+    finally:
+        os.chdir(cwd)
+        perf.log_summary()
+        if args.report:
+            perf.write(args.report)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(exit_code)
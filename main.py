@@ -1,22 +1,134 @@
 import argparse
+import base64
+import concurrent.futures
+import contextlib
+import copy
+import csv
+import gzip
+import hashlib
 import json
 import logging
+import math
 import os
+import posixpath
+import queue
 import re
+import shutil
 import string
+import subprocess
 import sys
+import threading
 import time
-from urllib.parse import urljoin, urlparse, urlunparse
+import zipfile
+from urllib.parse import unquote, urljoin, urlparse, urlunparse
 
 import requests
 import selenium.webdriver.support.expected_conditions as EC
-import wget
 import yt_dlp
+from bs4 import BeautifulSoup
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from requests.adapters import HTTPAdapter
 from selenium.common import TimeoutException
 from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.remote.webdriver import By
 from selenium.webdriver.support.wait import WebDriverWait
 from seleniumbase import Driver
+from urllib3.util.retry import Retry
+
+# Endpoint the complete button of a lecture posts to
+LECTURE_COMPLETE_PATH = "/api/v1/courses/{course_id}/lectures/{lecture_id}/complete"
+
+# Seconds to wait for the complete button to be replaced after clicking it, the time the fixed sleep used to take
+COMPLETE_BUTTON_TIMEOUT = 3
+
+# Reads the media link from the __NEXT_DATA__ of a player frame, null while the frame is still loading
+READ_MEDIA_LINK_SCRIPT = (
+    "var data = document.getElementById('__NEXT_DATA__');"
+    "if (data === null) return document.readyState === 'complete' ? {link: null} : null;"
+    "try { return {link: JSON.parse(data.textContent).props.pageProps.applicationData.mediaAssets[0].urlEncrypted}; }"
+    "catch (e) { return {link: null}; }"
+)
+
+# Collects everything the downloader reads from a lecture page in a single call. The frames are returned with their
+# index in window.frames, which the driver can switch to without looking the iframe elements up again
+READ_LECTURE_PAGE_SCRIPT = """
+var links = function (selector) {
+    var container = document.querySelector(selector);
+    if (container === null) return [];
+    return Array.prototype.map.call(container.querySelectorAll('a'), function (a) {
+        return {link: a.href, name: a.innerText.trim()};
+    });
+};
+var frames = [];
+document.querySelectorAll("iframe[data-testid^='embed-player']").forEach(function (iframe) {
+    for (var i = 0; i < window.frames.length; i++) {
+        if (window.frames[i] === iframe.contentWindow) {
+            frames.push({index: i, src: iframe.src});
+            return;
+        }
+    }
+});
+var button = document.getElementById('lecture_complete_button');
+var csrf = document.querySelector('meta[name=csrf-token]');
+var heading = document.getElementById('lecture_heading');
+// The same html as the page source of the driver, a serializer would escape the scripts as xml
+var doctype = document.doctype === null ? '' : '<!DOCTYPE ' + document.doctype.name +
+    (document.doctype.publicId ? ' PUBLIC "' + document.doctype.publicId + '"' : '') +
+    (document.doctype.systemId ? (document.doctype.publicId ? '' : ' SYSTEM') + ' "' + document.doctype.systemId + '"'
+                               : '') + '>';
+return {
+    title: document.title,
+    heading: heading === null ? '' : heading.innerText.trim(),
+    attachments: links('.lecture-attachment-type-file'),
+    videoAttachments: links('.lecture-attachment-type-video'),
+    frames: frames,
+    completeButton: button === null ? null : {courseId: button.getAttribute('data-course-id'),
+                                              lectureId: button.getAttribute('data-lecture-id')},
+    csrf: csrf === null ? null : csrf.content,
+    html: doctype + document.documentElement.outerHTML
+};
+"""
+
+# Folder of a chapter the browser downloads video attachments to, in a subfolder per lecture
+BROWSER_DOWNLOAD_FOLDER = ".browser-download"
+
+# Folder of a chapter the fast remux downloads videos to, before they are remuxed to their final path
+POSTPROCESS_FOLDER = ".postprocess"
+
+# Number of times yt-dlp retries a fragment, the default of its command line, the API does not retry at all
+FRAGMENT_RETRIES = 10
+
+# Seconds after lowering the concurrent fragments before the next 429/403 lowers them again
+THROTTLE_COOLDOWN = 5
+
+# Page that needs a logged in user, requested to check if a cached session is still valid
+SESSION_CHECK_PATH = "/courses/enrolled"
+
+# Paths of the sign in pages of the schools and of their SSO, a session check that ends on one of them failed
+LOGIN_PATH_PATTERN = re.compile(r"sign_in|sign_up|login|identity", re.IGNORECASE)
+
+# PBKDF2 iterations deriving the key of the session cache from its passphrase
+SESSION_KDF_ITERATIONS = 480000
+
+# Number of subtitle playlists and segments fetched at once for a video
+SUBTITLE_FETCH_WORKERS = 8
+
+# Snapshots are written in slices of this many characters, so the page is never encoded as a whole
+SNAPSHOT_CHUNK_SIZE = 1024 * 1024
+
+# Inline scripts of at least this many characters are stored once per course by the compressed snapshot formats
+SNAPSHOT_SCRIPT_MIN_SIZE = 4096
+
+# Assets and trackers that are never used by the downloader, blocked by the headless crawl profile
+BLOCKED_URL_PATTERNS = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico", "*.woff", "*.woff2", "*.ttf", "*.otf",
+    # Player segments only, video attachments (.mp4) are still downloaded through the browser
+    "*.m4s", "*.m3u8",
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*facebook.net*", "*hotjar.com*",
+    "*segment.com*", "*segment.io*", "*mixpanel.com*", "*fullstory.com*", "*intercom.io*", "*clarity.ms*",
+]
 
 
 def create_folder(course_title):
@@ -47,9 +159,1288 @@ def truncate_title_to_fit_file_name(title, max_file_name_length=250):
     return title
 
 
+def element_text(element):
+    # Collapse the whitespace the way the browser renders the text of the element
+    if element is None:
+        return ""
+    return " ".join(element.get_text(" ").split())
+
+
+def make_soup(page_source):
+    # Allow the parsers to share one parsed document
+    if isinstance(page_source, BeautifulSoup):
+        return page_source
+    return BeautifulSoup(page_source, "html.parser")
+
+
+def parse_course_title(page_source, selector):
+    soup = make_soup(page_source)
+    return element_text(soup.select_one(selector))
+
+
+def parse_image_link(page_source, selector, base_url):
+    soup = make_soup(page_source)
+    image = soup.select_one(selector)
+    if image is None or not image.get("src"):
+        return None
+    return urljoin(base_url, image["src"])
+
+
+def parse_curriculum_colossal(page_source, base_url):
+    """
+    Parses the curriculum of a course using the colossal template (``.block__curriculum``).
+
+    :param page_source: str
+        The html of the course page, or its parsed BeautifulSoup document.
+    :param base_url: str
+        The url of the course page, used to resolve relative lecture links.
+    :return: List[dict]
+        The sections with their title, availability and lectures (title and link).
+    """
+    soup = make_soup(page_source)
+    sections = []
+    for section in soup.select(".block__curriculum__section"):
+        lectures = []
+        for item in section.select(".block__curriculum__section__list__item__link"):
+            lectures.append({
+                "title": element_text(item.select_one(".block__curriculum__section__list__item__lecture-name")),
+                "link": urljoin(base_url, item.get("href", ""))
+            })
+        sections.append({"title": element_text(section.select_one(".block__curriculum__section__title")),
+                         "available": True, "lectures": lectures})
+    return sections
+
+
+def parse_curriculum_classic(page_source, base_url):
+    """
+    Parses the curriculum of a course using the classic template (``.course-mainbar``).
+
+    :param page_source: str
+        The html of the course page, or its parsed BeautifulSoup document.
+    :param base_url: str
+        The url of the course page, used to resolve relative lecture links.
+    :return: List[dict]
+        The sections with their title, availability and lectures (title and link).
+    """
+    soup = make_soup(page_source)
+    sections = []
+    for section in soup.select(".course-section"):
+        lectures = []
+        for item in section.select(".section-item"):
+            link = item.select_one(".item")
+            lectures.append({
+                "title": element_text(item.select_one(".lecture-name")),
+                "link": urljoin(base_url, link.get("href", "")) if link else None
+            })
+        sections.append({"title": element_text(section.select_one(".section-title")), "available": True,
+                         "lectures": lectures})
+    return sections
+
+
+def parse_curriculum_simple(page_source, base_url):
+    """
+    Parses the curriculum of a course using the simple template (``#__next``). Sections with a drip tag are not
+    released yet and are marked as not available.
+
+    :param page_source: str
+        The html of the course page, or its parsed BeautifulSoup document.
+    :param base_url: str
+        The url of the course page, used to resolve relative lecture links.
+    :return: List[dict]
+        The sections with their title, availability and lectures (title and link).
+    """
+    soup = make_soup(page_source)
+    sections = []
+    for section in soup.select(".slim-section"):
+        lectures = []
+        for bar in section.select(".bar"):
+            video = bar.select_one(".text")
+            if video is None:
+                continue
+            lectures.append({"title": element_text(video), "link": urljoin(base_url, video.get("href", ""))})
+        sections.append({"title": element_text(section.select_one(".heading")),
+                         "available": section.select_one(".drip-tag") is None, "lectures": lectures})
+    return sections
+
+
+def build_video_list(sections, course_path):
+    chapter_idx = 0
+    video_list = []
+    for section in sections:
+        chapter_idx += 1
+        chapter_title = "{:02d}-{}".format(chapter_idx, clean_string(section["title"]))
+        logging.info("Found chapter: " + chapter_title)
+
+        if not section["available"]:
+            logging.warning('Chapter "%s" not available, skipping', chapter_title)
+            continue
+
+        download_path = os.path.join(course_path, chapter_title)
+        os.makedirs(download_path, exist_ok=True)
+
+        idx = 1
+        for lecture in section["lectures"]:
+            if not lecture["link"]:
+                continue
+            lecture_title = clean_string(lecture["title"])
+            lecture_title = ''.join(char for char in lecture_title if char in string.printable)
+            logging.info("Found lecture: " + lecture_title)
+
+            truncated_lecture_title = truncate_title_to_fit_file_name(lecture_title)
+            video_entity = {"link": lecture["link"], "title": truncated_lecture_title, "idx": idx,
+                            "download_path": download_path}
+            video_list.append(video_entity)
+            idx += 1
+    return video_list
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    # HTTPAdapter with a default timeout for the requests that do not set one
+    def __init__(self, *args, timeout=30, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class ReportingRetry(Retry):
+    # Retry that reports the status of every response it retries, which the session hooks never get to see
+    def __init__(self, *args, on_status=None, **kwargs):
+        self.on_status = on_status
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.on_status = self.on_status
+        return retry
+
+    def increment(self, method=None, url=None, response=None, *args, **kwargs):
+        if response is not None and self.on_status is not None:
+            self.on_status(response.status)
+        return super().increment(method, url, response, *args, **kwargs)
+
+
+def create_session(headers=None, pool_size=10, retries=3, timeout=30, on_status=None):
+    """
+    Creates the http session shared by every download that is not made by yt-dlp.
+
+    :param headers: dict
+        The default headers sent with every request.
+    :param pool_size: int
+        The number of connections kept alive per host.
+    :param retries: int
+        The number of retries, with exponential backoff, on connection errors and 429/5xx responses.
+    :param timeout: int
+        The default connect and read timeout in seconds.
+    :param on_status: Callable[[int], None] | None
+        Called with the status of every response that is retried.
+    :return: requests.Session
+    """
+    session = requests.Session()
+    if headers:
+        session.headers.update({key: value for key, value in headers.items() if value})
+    retry = ReportingRetry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                           raise_on_status=False, on_status=on_status)
+    adapter = TimeoutHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry,
+                                 timeout=timeout)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class DirectorySync:
+    """
+    Batches the syncs of the output per directory instead of syncing after every file. Files written with defer are
+    held under their temporary name until their directory is synced, then synced and moved into place together, the
+    other files are synced before they are moved and only their directory is left to the batch. Until a directory is
+    synced a power loss may lose its newest files, but never leaves a truncated file behind under a final name.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.deferred = {}
+
+    def add(self, file_path):
+        with self.lock:
+            self.pending.add(os.path.dirname(os.path.abspath(file_path)))
+
+    def defer(self, temp_path, file_path):
+        # A newer version of a deferred file replaces the one that was still waiting
+        file_path = os.path.abspath(file_path)
+        with self.lock:
+            files = self.deferred.setdefault(os.path.dirname(file_path), {})
+            previous = files.get(file_path)
+            files[file_path] = temp_path
+        if previous is not None and previous != temp_path and os.path.exists(previous):
+            os.remove(previous)
+
+    def sync(self, directory=None):
+        """
+        Syncs and moves the deferred files of the pending directories into place, and syncs the directories.
+
+        :param directory: str | None
+            The directory to sync, None to sync every pending directory.
+        """
+        with self.lock:
+            if directory is None:
+                pending, self.pending = self.pending | set(self.deferred), set()
+                deferred, self.deferred = self.deferred, {}
+            else:
+                directory = os.path.abspath(directory)
+                pending = {directory} & (self.pending | set(self.deferred))
+                self.pending.discard(directory)
+                deferred = {directory: self.deferred.pop(directory)} if directory in self.deferred else {}
+
+        for files in deferred.values():
+            for file_path, temp_path in files.items():
+                fsync_path(temp_path)
+                try:
+                    os.replace(temp_path, file_path)
+                except OSError as e:
+                    logging.warning("Could not move " + temp_path + " into place: " + str(e))
+        for directory in pending:
+            fsync_path(directory)
+        if pending:
+            logging.debug("Synced " + str(sum(len(files) for files in deferred.values())) + " deferred files in " +
+                          str(len(pending)) + " directories")
+
+
+def fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Already moved on, or a directory on a platform that can not open them (Windows)
+        return
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        logging.debug("Could not sync " + path + ": " + str(e))
+    finally:
+        os.close(fd)
+
+
+# Shared by every writer of the run, synced per chapter and at the end of every course
+output_sync = DirectorySync()
+
+
+def replace_file(source_path, file_path, synced=False):
+    # Syncs a complete file before moving it to its final name, only the sync of its directory is left to the batch
+    if not synced:
+        fsync_path(source_path)
+    os.replace(source_path, file_path)
+    output_sync.add(file_path)
+
+
+@contextlib.contextmanager
+def atomic_write(file_path, mode="wb", encoding=None, newline=None, defer=False, transient=False, opener=None):
+    """
+    Opens a temporary file next to file_path and moves it over file_path once the block finished without an error,
+    so file_path is either missing or complete and a file that exists can be trusted without hashing it.
+
+    :param file_path: str
+        The final path of the file.
+    :param mode: str
+        The mode the temporary file is opened with, "wb" or "w".
+    :param encoding: str | None
+        The encoding of text modes.
+    :param newline: str | None
+        The newline translation of text modes.
+    :param defer: bool
+        Leave the sync and the move to the next sync of the directory by output_sync, for files that are not read
+        back before that.
+    :param transient: bool
+        Move the file into place without syncing it, for state that is rewritten all the time and can be lost.
+    :param opener: Callable[[str, int], int] | None
+        Opens the temporary file, to create it with other permissions.
+    """
+    temp_path = "{}.{}.tmp".format(file_path, threading.get_ident())
+    try:
+        with open(temp_path, mode, encoding=encoding, newline=newline, opener=opener) as f:
+            yield f
+            if not defer and not transient:
+                f.flush()
+                os.fsync(f.fileno())
+        if defer:
+            output_sync.defer(temp_path, file_path)
+            temp_path = None
+        elif transient:
+            os.replace(temp_path, file_path)
+        else:
+            replace_file(temp_path, file_path, synced=True)
+    finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def get_filename_from_response(response, fallback):
+    content_disposition = response.headers.get("Content-Disposition", "")
+    match = re.search(r"filename\*=(?:UTF-8'')?([^;]+)", content_disposition, re.IGNORECASE) or \
+        re.search(r'filename="?([^";]+)"?', content_disposition, re.IGNORECASE)
+    if match:
+        file_name = unquote(match.group(1).strip())
+    else:
+        file_name = unquote(os.path.basename(urlparse(response.url).path))
+    # Never let the server pick a path outside of the output folder
+    file_name = os.path.basename(file_name.replace("\\", "/")).strip()
+    return file_name or fallback
+
+
+def download_file(session, url, output_path, fallback_name, attempts=5, chunk_size=1024 * 1024, throttle=None,
+                  reuse=None):
+    """
+    Streams a file to ``<name>.part`` in fixed size chunks and renames it once it is complete. An interrupted
+    download is resumed with a Range request, both within this call and across runs, as long as the ETag of the file
+    did not change.
+
+    :param session: requests.Session
+        The session used for the requests.
+    :param url: str
+        The url of the file.
+    :param output_path: str
+        The folder the file is saved in, the name is taken from the response.
+    :param fallback_name: str
+        The name used when the response does not provide one.
+    :param attempts: int
+        The number of attempts before giving up.
+    :param chunk_size: int
+        The number of bytes written at a time.
+    :param throttle: Callable[[int], None] | None
+        Called with the size of every chunk that was read, to limit the bandwidth.
+    :param reuse: Callable[[str, int, str], bool] | None
+        Called with the ETag, size and path of the file once the response headers are known, returns True when it
+        provided the file itself so its content is not downloaded.
+    :return: str
+        The path of the downloaded file.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return download_file_attempt(session, url, output_path, fallback_name, chunk_size, throttle, reuse)
+        except (requests.RequestException, IOError) as e:
+            status_code = e.response.status_code if isinstance(e, requests.HTTPError) and e.response is not None \
+                else None
+            # Client errors will not go away by asking again, only timeouts and rate limits are retried
+            if attempt == attempts or (status_code and 400 <= status_code < 500 and status_code not in (408, 429)):
+                raise
+            logging.warning("Download of " + fallback_name + " interrupted (" + str(e) + "), retrying " +
+                            str(attempt) + "/" + str(attempts - 1))
+            time.sleep(min(2 ** attempt, 30))
+
+
+def download_file_attempt(session, url, output_path, fallback_name, chunk_size, throttle=None, reuse=None):
+    # Ask for the raw bytes so Content-Length and Range offsets match what is written to disk
+    headers = {"Accept-Encoding": "identity"}
+    response = session.get(url, headers=headers, stream=True)
+    try:
+        response.raise_for_status()
+        file_path = os.path.join(output_path, get_filename_from_response(response, fallback_name))
+        part_path = file_path + ".part"
+        state_path = part_path + ".json"
+        total_size = int(response.headers.get("Content-Length", 0)) or None
+        etag = response.headers.get("ETag")
+
+        if os.path.isfile(file_path) and total_size is not None and os.path.getsize(file_path) == total_size:
+            logging.info("Skipping existing file: " + file_path)
+            return file_path
+
+        if reuse is not None and reuse(etag, total_size, file_path):
+            return file_path
+
+        resume_from = 0
+        if os.path.isfile(part_path) and os.path.isfile(state_path):
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("etag") == etag and state.get("size") == total_size and \
+                    response.headers.get("Accept-Ranges") == "bytes":
+                resume_from = os.path.getsize(part_path)
+
+        if resume_from and (total_size is None or resume_from < total_size):
+            response.close()
+            headers["Range"] = "bytes=" + str(resume_from) + "-"
+            if etag:
+                headers["If-Range"] = etag
+            response = session.get(url, headers=headers, stream=True)
+            response.raise_for_status()
+            if response.status_code != 206:
+                # The file changed on the server, start over
+                resume_from = 0
+            else:
+                logging.info("Resuming download of " + file_path + " at " + str(resume_from) + " bytes")
+        elif total_size is not None and resume_from == total_size:
+            response.close()
+        else:
+            resume_from = 0
+
+        with atomic_write(state_path, "w", encoding="utf-8", transient=True) as f:
+            json.dump({"url": url, "etag": etag, "size": total_size}, f)
+
+        if total_size is None or resume_from < total_size:
+            with open(part_path, "ab" if resume_from else "wb") as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    if throttle is not None:
+                        throttle(len(chunk))
+    finally:
+        response.close()
+
+    written_size = os.path.getsize(part_path)
+    if total_size is not None and written_size != total_size:
+        raise IOError("incomplete download, got " + str(written_size) + " of " + str(total_size) + " bytes")
+    # Single part S3 style ETags are the md5 of the content
+    if etag and re.fullmatch(r'"?[0-9a-f]{32}"?', etag) and file_md5(part_path) != etag.strip('"'):
+        os.remove(part_path)
+        raise IOError("checksum mismatch for " + file_path)
+
+    replace_file(part_path, file_path)
+    os.remove(state_path)
+    return file_path
+
+
+def file_md5(file_path, chunk_size=1024 * 1024):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def ffprobe_format_entry(file_path, entry):
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe is None:
+        return None
+    try:
+        result = subprocess.run([ffprobe, "-v", "error", "-show_entries", "format=" + entry, "-of",
+                                 "default=noprint_wrappers=1:nokey=1", file_path],
+                                capture_output=True, text=True, timeout=30)
+    except subprocess.SubprocessError:
+        return ""
+    return result.stdout.strip()
+
+
+def probe_duration(file_path):
+    duration = ffprobe_format_entry(file_path, "duration")
+    if duration is None:
+        return None
+    try:
+        return float(duration)
+    except ValueError:
+        return 0.0
+
+
+def remux_video(input_file, output_file, metadata):
+    """
+    Moves a downloaded video to its final mp4 path, copying the streams into an mp4 container and writing the
+    metadata in a single ffmpeg pass. A download that is an mp4 already is only moved when there is no metadata to
+    write.
+
+    :param input_file: str
+        The video as downloaded by yt-dlp.
+    :param output_file: str
+        The final path of the video.
+    :param metadata: dict
+        The metadata tags written to the video when it is remuxed.
+    :return: str
+        The final path of the video.
+    """
+    format_name = ffprobe_format_entry(input_file, "format_name") or ""
+    if "mp4" in format_name.split(",") and not any(metadata.values()):
+        logging.debug("Video is already an mp4, skipping remux: " + input_file)
+        replace_file(input_file, output_file)
+        return output_file
+
+    logging.debug("Remuxing " + format_name + " video: " + input_file)
+    temp_file = output_file + ".part"
+    command = [shutil.which("ffmpeg"), "-y", "-loglevel", "error", "-i", input_file, "-c", "copy"]
+    for key, value in metadata.items():
+        if value:
+            command += ["-metadata", key + "=" + str(value)]
+    command += ["-f", "mp4", temp_file]
+    subprocess.run(command, check=True, capture_output=True)
+    replace_file(temp_file, output_file)
+    os.remove(input_file)
+    return output_file
+
+
+def remove_postprocess_folders(video_list):
+    # The unprocessed downloads are moved out once remuxed, only the folders of failed downloads keep their parts
+    for chapter_path in {video["download_path"] for video in video_list}:
+        try:
+            os.rmdir(os.path.join(chapter_path, POSTPROCESS_FOLDER))
+        except OSError:
+            pass
+
+
+def is_video_complete(file_path, expected_size=None):
+    """
+    Checks if a video was completely downloaded by a previous run, without asking yt-dlp.
+
+    :param file_path: str
+        The final path of the video.
+    :param expected_size: int
+        The size recorded in the manifest when the video was downloaded, if any.
+    :return: bool
+    """
+    if not os.path.isfile(file_path) or os.path.getsize(file_path) == 0:
+        return False
+    if expected_size is not None:
+        return os.path.getsize(file_path) == expected_size
+    # yt-dlp keeps these next to the video until the download is finished
+    if os.path.exists(file_path + ".part") or os.path.exists(file_path + ".ytdl"):
+        return False
+
+    duration = probe_duration(file_path)
+    if duration is None:
+        logging.debug("ffprobe not found, trusting existing video: " + file_path)
+        return True
+    return duration > 0
+
+
+def wait_for_directory_change(path, since_mtime, timeout, poll_interval=0.05):
+    # The standard library has no file system notifications, but the mtime of a directory changes whenever an
+    # entry is created, renamed or removed in it, which is a single cheap stat call to check
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.stat(path).st_mtime_ns != since_mtime:
+            return True
+        time.sleep(poll_interval)
+    return False
+
+
+def is_logged_in_url(url, school_host):
+    # A session is only logged in when the school answered itself, not with a redirect to a sign in or SSO page
+    parsed_url = urlparse(url)
+    return parsed_url.netloc == school_host and not LOGIN_PATH_PATTERN.search(parsed_url.path)
+
+
+def get_completion_request(lecture_url, course_id=None, lecture_id=None, csrf_token=None):
+    # Fall back to the ids in the lecture url when the complete button does not carry them
+    parsed_url = urlparse(lecture_url)
+    match = re.search(r"/courses/(?:enrolled/)?([^/]+)/lectures/(\d+)", parsed_url.path)
+    if match:
+        course_id = course_id or match.group(1)
+        lecture_id = lecture_id or match.group(2)
+    if not course_id or not lecture_id:
+        return None
+
+    path = LECTURE_COMPLETE_PATH.format(course_id=course_id, lecture_id=lecture_id)
+    return {"url": urlunparse((parsed_url.scheme, parsed_url.netloc, path, "", "", "")), "csrf_token": csrf_token}
+
+
+def parse_m3u8_segments(playlist, playlist_url):
+    # The segment uris are the lines that are not tags or comments, in stream order
+    return [urljoin(playlist_url, line.strip()) for line in playlist.splitlines()
+            if line.strip() and not line.startswith("#")]
+
+
+def merge_vtt_segments(segments):
+    """
+    Joins the WebVTT segments of a subtitle playlist in stream order, keeping only the header of the first segment.
+
+    :param segments: List[bytes]
+        The content of the segments.
+    :return: bytes
+        The content of the single WebVTT file.
+    """
+    parts = []
+    for i, segment in enumerate(segments):
+        text = segment.decode("utf-8-sig", "replace").replace("\r\n", "\n")
+        if i > 0 and text.startswith("WEBVTT"):
+            # The header block ends at the first blank line
+            text = text.partition("\n\n")[2]
+        text = text.strip("\n")
+        if text:
+            parts.append(text)
+    return ("\n\n".join(parts) + "\n").encode("utf-8")
+
+
+def save_curriculum_snapshot(video_list, course_path):
+    snapshot = [{"link": video["link"], "title": video["title"], "idx": video["idx"],
+                 "chapter": os.path.basename(video["download_path"])} for video in video_list]
+    with atomic_write(os.path.join(course_path, "curriculum.json"), "w", encoding="utf-8", defer=True) as f:
+        json.dump(snapshot, f, indent=2)
+
+
+def load_curriculum_snapshot(course_path):
+    snapshot_path = os.path.join(course_path, "curriculum.json")
+    if not os.path.isfile(snapshot_path):
+        return None
+    try:
+        with open(snapshot_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning("Could not read curriculum snapshot: " + snapshot_path)
+        return None
+
+
+def diff_curriculum(previous, video_list):
+    """
+    Compares the curriculum snapshot of a previous run with the current lectures, matching them by link.
+
+    :param previous: List[dict]
+        The snapshot entries with the link, title, idx and chapter (folder name) keys.
+    :param video_list: List[dict]
+        The current lectures as built by the download_course_* methods.
+    :return: tuple
+        The new lectures, the (snapshot entry, lecture) pairs that changed title, position or chapter, and the
+        snapshot entries of the lectures that are gone.
+    """
+    previous_by_link = {lecture["link"]: lecture for lecture in previous}
+    current_links = set()
+    added = []
+    moved = []
+    for video in video_list:
+        current_links.add(video["link"])
+        old = previous_by_link.get(video["link"])
+        if old is None:
+            added.append(video)
+        elif (old["title"], old["idx"], old["chapter"]) != \
+                (video["title"], video["idx"], os.path.basename(video["download_path"])):
+            moved.append((old, video))
+    removed = [lecture for lecture in previous if lecture["link"] not in current_links]
+    return added, moved, removed
+
+
+def percentile(sorted_values, percent):
+    # Nearest rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(math.ceil(percent / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class CourseManifest:
+    """
+    Per course record of the download state of every lecture, stored as JSONL in the course folder.
+
+    Every update is appended as a new line, the lines of a lecture are merged in order when the manifest is loaded,
+    so a run that is killed halfway loses at most the line it was writing.
+    """
+
+    def __init__(self, course_path):
+        self.path = os.path.join(course_path, "manifest.jsonl")
+        self.lock = threading.Lock()
+        self.lectures = {}
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning("Skipping corrupt manifest line in: " + self.path)
+                    continue
+                self.lectures.setdefault(record["link"], {}).update(record)
+
+        # Rewrite the manifest with a single line per lecture
+        with atomic_write(self.path, "w", encoding="utf-8") as f:
+            for record in self.lectures.values():
+                f.write(json.dumps(record) + "\n")
+        logging.info("Loaded manifest with " + str(len(self.lectures)) + " lectures: " + self.path)
+
+    def get(self, link):
+        with self.lock:
+            return copy.deepcopy(self.lectures.get(link, {}))
+
+    def update(self, link, **fields):
+        with self.lock:
+            fields = copy.deepcopy(fields)
+            self.lectures.setdefault(link, {"link": link}).update(fields)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(dict(fields, link=link)) + "\n")
+
+    def update_media(self, link, media_idx, **fields):
+        with self.lock:
+            media = self.lectures.get(link, {}).get("media", [])
+            if media_idx >= len(media):
+                return
+            media[media_idx].update(fields)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"link": link, "media": media}) + "\n")
+
+
+class BlobStore:
+    """
+    Content addressed store of the downloaded files, shared by all courses. Every file is kept once under its sha256
+    and hardlinked into the lecture folders, falling back to a copy where hardlinks are not supported. Files are
+    looked up by their url, or by the ETag the server sends for them, before their content is downloaded.
+
+    The index is stored as JSONL next to the blobs, one line per url.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, "index.jsonl")
+        self.lock = threading.Lock()
+        self.by_url = {}
+        self.by_etag = {}
+        os.makedirs(root, exist_ok=True)
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.index_path):
+            return
+
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning("Skipping corrupt blob index line in: " + self.index_path)
+                    continue
+                self.index(entry)
+        logging.info("Loaded blob store with " + str(len(self.by_url)) + " files: " + self.root)
+
+    def index(self, entry):
+        self.by_url[entry["url"]] = entry
+        etag_key = self.etag_key(entry["url"], entry.get("etag"))
+        if etag_key:
+            self.by_etag[etag_key] = entry
+
+    @staticmethod
+    def etag_key(url, etag):
+        # Weak ETags do not identify the content, strong ones only within a host
+        if not etag or etag.startswith("W/"):
+            return None
+        return urlparse(url).netloc + " " + etag
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def find(self, url, etag=None):
+        with self.lock:
+            entry = self.by_url.get(url) or self.by_etag.get(self.etag_key(url, etag))
+        if entry is None or not os.path.isfile(self.blob_path(entry["sha256"])):
+            return None
+        return entry
+
+    def record(self, url, etag, sha256, size, name):
+        entry = {"url": url, "etag": etag, "sha256": sha256, "size": size, "name": name}
+        with self.lock:
+            self.index(entry)
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def link(self, entry, file_path):
+        # Replaces the file with a link to the blob of the entry
+        blob_path = self.blob_path(entry["sha256"])
+        if os.path.isfile(file_path) and os.path.samefile(blob_path, file_path):
+            return
+        link_path = file_path + ".link"
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        try:
+            os.link(blob_path, link_path)
+        except OSError:
+            shutil.copyfile(blob_path, link_path)
+        replace_file(link_path, file_path)
+
+    def add(self, file_path, url, etag=None):
+        """
+        Adds a downloaded file to the store. A file whose content is stored already is replaced by a link to the
+        stored copy.
+
+        :param file_path: str
+            The path of the downloaded file.
+        :param url: str
+            The url the file was downloaded from.
+        :param etag: str | None
+            The ETag the server sent for the file.
+        :return: dict
+            The index entry of the file.
+        """
+        sha256 = file_sha256(file_path)
+        blob_path = self.blob_path(sha256)
+        entry = {"sha256": sha256}
+        if os.path.isfile(blob_path):
+            self.link(entry, file_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                os.link(file_path, blob_path)
+            except OSError:
+                shutil.copyfile(file_path, blob_path + ".tmp")
+                replace_file(blob_path + ".tmp", blob_path)
+        return self.record(url, etag, sha256, os.path.getsize(file_path), os.path.basename(file_path))
+
+    def download(self, session, url, output_path, fallback_name, throttle=None):
+        """
+        Downloads a file like download_file, taking it from the store instead when its url or ETag is known.
+
+        :return: str
+            The path of the file in output_path.
+        """
+        entry = self.find(url)
+        if entry is not None:
+            file_path = os.path.join(output_path, entry["name"])
+            self.link(entry, file_path)
+            logging.info("Linked " + entry["name"] + " from the blob store")
+            return file_path
+
+        state = {}
+
+        def reuse(etag, size, file_path):
+            state["etag"] = etag
+            entry = self.find(url, etag)
+            if entry is None or (size is not None and entry["size"] != size):
+                return False
+            self.link(entry, file_path)
+            state["entry"] = entry
+            logging.info("Linked " + os.path.basename(file_path) + " from the blob store")
+            return True
+
+        file_path = download_file(session, url, output_path, fallback_name, throttle=throttle, reuse=reuse)
+        if "entry" in state:
+            # Remember the new url of the same content
+            self.record(url, state["etag"], state["entry"]["sha256"], state["entry"]["size"],
+                        os.path.basename(file_path))
+        else:
+            self.add(file_path, url, state.get("etag"))
+        return file_path
+
+
+class SnapshotWriter:
+    """
+    Writes the html snapshots of a course in one of the snapshot formats:
+
+    - html: every page as a plain html file.
+    - gzip: every page as a gzip compressed ``.html.gz`` file. The large inline scripts the pages repeat are stored
+      once under ``.scripts/<sha256>.js.gz`` and left empty in the pages, with a ``data-snapshot-script`` attribute
+      holding their sha256.
+    - zip: the pages and their deduplicated scripts (``scripts/<sha256>.js``) bundled in ``snapshots.zip`` in the
+      course folder, indexed by the directory of the archive. The pages are staged as files under ``.snapshots``
+      and the archive is rebuilt with them through a temporary file by close, replacing the entries of the same
+      name, so it never holds duplicates and a crash leaves the previous archive intact.
+    """
+
+    FORMATS = ["html", "gzip", "zip"]
+
+    def __init__(self, course_path, snapshot_format="html"):
+        self.course_path = course_path
+        self.format = snapshot_format
+        self.lock = threading.Lock()
+        self.scripts = set()
+        self.archive_path = os.path.join(course_path, "snapshots.zip")
+        self.staging_path = os.path.join(course_path, ".snapshots")
+        self.scripts_path = os.path.join(course_path, ".scripts")
+        if self.format == "zip" and os.path.isfile(self.archive_path):
+            try:
+                with zipfile.ZipFile(self.archive_path, "r") as archive:
+                    self.scripts.update(posixpath.splitext(posixpath.basename(name))[0]
+                                        for name in archive.namelist() if name.startswith("scripts/"))
+            except zipfile.BadZipFile:
+                logging.warning("Snapshot archive is corrupt, starting a new one: " + self.archive_path)
+                os.replace(self.archive_path, self.archive_path + ".corrupt")
+        if self.format == "zip" and os.path.isdir(os.path.join(self.staging_path, "scripts")):
+            self.scripts.update(file_name[:-len(".js")] for file_name in
+                                os.listdir(os.path.join(self.staging_path, "scripts")) if file_name.endswith(".js"))
+
+    def write(self, page_source, file_path):
+        """
+        Writes the snapshot of a page.
+
+        :param page_source: str
+            The html of the page.
+        :param file_path: str
+            The path of the plain html file of the page, the compressed formats derive their name from it.
+        :return: str
+            The path of the file the snapshot was written to.
+        """
+        if self.format == "html":
+            with atomic_write(file_path, "w", encoding="utf-8", defer=True) as f:
+                f.write(page_source)
+            return file_path
+
+        page_source = self.dedup_scripts(page_source)
+        if self.format == "gzip":
+            output_file = file_path + ".gz"
+            with atomic_write(output_file, defer=True) as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for i in range(0, len(page_source), SNAPSHOT_CHUNK_SIZE):
+                    f.write(page_source[i:i + SNAPSHOT_CHUNK_SIZE].encode("utf-8"))
+            return output_file
+
+        name = os.path.relpath(file_path, self.course_path).replace(os.sep, "/")
+        staged_file = os.path.join(self.staging_path, *name.split("/"))
+        os.makedirs(os.path.dirname(staged_file), exist_ok=True)
+        with atomic_write(staged_file, "w", encoding="utf-8") as f:
+            for i in range(0, len(page_source), SNAPSHOT_CHUNK_SIZE):
+                f.write(page_source[i:i + SNAPSHOT_CHUNK_SIZE])
+        return self.archive_path + ":" + name
+
+    def close(self):
+        """
+        Rebuilds the archive of the zip format with the staged pages and scripts, keeping the entries of the previous
+        archive that were not staged again. Pages staged by an interrupted run are picked up as well.
+        """
+        if self.format != "zip" or not os.path.isdir(self.staging_path):
+            return
+
+        with self.lock:
+            staged = {}
+            for root, dirs, files in os.walk(self.staging_path):
+                for file_name in files:
+                    if file_name.endswith(".tmp"):
+                        # Left behind by a write that was interrupted
+                        continue
+                    staged_file = os.path.join(root, file_name)
+                    staged[os.path.relpath(staged_file, self.staging_path).replace(os.sep, "/")] = staged_file
+
+            with atomic_write(self.archive_path) as raw, zipfile.ZipFile(raw, "w", zipfile.ZIP_DEFLATED) as archive:
+                if os.path.isfile(self.archive_path):
+                    with zipfile.ZipFile(self.archive_path, "r") as previous:
+                        for info in previous.infolist():
+                            if info.filename in staged:
+                                continue
+                            with previous.open(info) as source, archive.open(info, "w") as target:
+                                shutil.copyfileobj(source, target, SNAPSHOT_CHUNK_SIZE)
+                for name in sorted(staged):
+                    archive.write(staged[name], name)
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+        logging.debug("Added " + str(len(staged)) + " snapshots to " + self.archive_path)
+
+    def dedup_scripts(self, page_source):
+        def replace_script(match):
+            attributes, script = match.group(1), match.group(2)
+            if len(script) < SNAPSHOT_SCRIPT_MIN_SIZE:
+                return match.group(0)
+            sha256 = hashlib.sha256(script.encode("utf-8")).hexdigest()
+            self.store_script(sha256, script)
+            return "<script" + attributes + ' data-snapshot-script="' + sha256 + '"></script>'
+
+        return re.sub(r"<script\b([^>]*)>(.*?)</script>", replace_script, page_source, flags=re.DOTALL | re.IGNORECASE)
+
+    def store_script(self, sha256, script):
+        with self.lock:
+            if sha256 in self.scripts:
+                return
+            if self.format == "gzip":
+                os.makedirs(self.scripts_path, exist_ok=True)
+                script_file = os.path.join(self.scripts_path, sha256 + ".js.gz")
+                if not os.path.isfile(script_file):
+                    with atomic_write(script_file) as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                        f.write(script.encode("utf-8"))
+            else:
+                script_file = os.path.join(self.staging_path, "scripts", sha256 + ".js")
+                os.makedirs(os.path.dirname(script_file), exist_ok=True)
+                with atomic_write(script_file, "w", encoding="utf-8") as f:
+                    f.write(script)
+            self.scripts.add(sha256)
+
+
+class SessionCache:
+    """
+    Encrypted store of logged in sessions, one file per school domain and account. The cookies and user agent of the
+    browser are encrypted with Fernet, using a key derived with PBKDF2 from a passphrase and a random salt per file.
+    """
+
+    def __init__(self, path, passphrase):
+        self.path = path
+        self.passphrase = passphrase.encode("utf-8")
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+    def file_path(self, domain, account):
+        name = hashlib.sha256((domain + "\n" + (account or "")).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, name + ".session")
+
+    def derive_key(self, salt):
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=SESSION_KDF_ITERATIONS)
+        return base64.urlsafe_b64encode(kdf.derive(self.passphrase))
+
+    def load(self, domain, account):
+        file_path = self.file_path(domain, account)
+        if not os.path.isfile(file_path):
+            return None
+
+        with open(file_path, "rb") as f:
+            data = f.read()
+        try:
+            return json.loads(Fernet(self.derive_key(data[:16])).decrypt(data[16:]))
+        except (InvalidToken, ValueError):
+            logging.warning("Could not decrypt the cached session of " + domain + ", wrong session key?")
+            return None
+
+    def save(self, domain, account, session):
+        salt = os.urandom(16)
+        token = Fernet(self.derive_key(salt)).encrypt(json.dumps(session).encode("utf-8"))
+        # Only the user may read the cached sessions
+        with atomic_write(self.file_path(domain, account),
+                          opener=lambda path, flags: os.open(path, flags, 0o600)) as f:
+            f.write(salt + token)
+
+    def remove(self, domain, account):
+        file_path = self.file_path(domain, account)
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+
+class LectureCompletionQueue:
+    """
+    Marks lectures as complete over http from a background thread, so the downloads never wait on it. The lectures
+    that could not be completed are returned by close() to be completed in the browser instead.
+    """
+
+    def __init__(self, session, on_complete, perf):
+        self.session = session
+        self.on_complete = on_complete
+        self.perf = perf
+        self.requests = queue.Queue()
+        self.failed = []
+        self.thread = None
+
+    def put(self, video, completion):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="lecture-completion", daemon=True)
+            self.thread.start()
+        self.requests.put((video, completion))
+
+    def run(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            video, completion = item
+            parsed_url = urlparse(video["link"])
+            headers = {"Origin": parsed_url.scheme + "://" + parsed_url.netloc, "Referer": video["link"],
+                       "X-Requested-With": "XMLHttpRequest"}
+            if completion.get("csrf_token"):
+                headers["X-CSRF-Token"] = completion["csrf_token"]
+            try:
+                with self.perf.span("lecture_completion", video["title"]):
+                    response = self.session.post(completion["url"], headers=headers)
+                    response.raise_for_status()
+            except Exception as e:
+                logging.warning("Could not complete lecture over http: " + video["title"] + " cause: " + str(e))
+                self.failed.append(video)
+                continue
+            logging.info("Completed lecture: " + video["title"])
+            self.on_complete(video)
+
+    def defer(self, video):
+        # Lectures without a completion request are returned by close() to be completed in the browser
+        self.failed.append(video)
+
+    def close(self):
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+        failed, self.failed = self.failed, []
+        return failed
+
+
+class PerformanceReport:
+    """
+    Collects timing spans of the phases of a run, with the bytes they transferred, for the end of run summary and
+    the JSON/CSV report.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.start_time = time.time()
+
+    @contextlib.contextmanager
+    def span(self, phase, label=""):
+        # The caller can set the "bytes" of the yielded span once it knows them
+        span = {"bytes": 0}
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self.record(phase, label, time.perf_counter() - start, span["bytes"])
+
+    def record(self, phase, label, duration, nbytes=0):
+        with self.lock:
+            self.spans.append({"phase": phase, "label": label, "start": round(time.time() - duration, 3),
+                               "duration": round(duration, 4), "bytes": nbytes})
+
+    def summary(self):
+        with self.lock:
+            spans = list(self.spans)
+        phases = {}
+        for span in spans:
+            phases.setdefault(span["phase"], []).append(span)
+
+        summary = {}
+        for phase, phase_spans in phases.items():
+            durations = sorted(span["duration"] for span in phase_spans)
+            total_duration = sum(durations)
+            total_bytes = sum(span["bytes"] for span in phase_spans)
+            summary[phase] = {
+                "count": len(durations),
+                "total": round(total_duration, 3),
+                "p50": round(percentile(durations, 50), 3),
+                "p95": round(percentile(durations, 95), 3),
+                "bytes": total_bytes,
+                "throughput": round(total_bytes / total_duration) if total_duration > 0 else 0,
+            }
+        return summary
+
+    def log_summary(self):
+        # Printed to stderr, so the summary shows at every verbosity without mixing into the output of yt-dlp
+        summary = self.summary()
+        if not summary:
+            return
+        lines = ["Performance summary, run took {:.1f}s".format(time.time() - self.start_time),
+                 "{:<20} {:>6} {:>10} {:>8} {:>8} {:>10} {:>10}".format("phase", "count", "total s", "p50 s",
+                                                                        "p95 s", "MB", "MB/s")]
+        for phase, stats in sorted(summary.items(), key=lambda item: -item[1]["total"]):
+            lines.append("{:<20} {:>6} {:>10.1f} {:>8.2f} {:>8.2f} {:>10.1f} {:>10.2f}".format(
+                phase, stats["count"], stats["total"], stats["p50"], stats["p95"], stats["bytes"] / 1e6,
+                stats["throughput"] / 1e6))
+        print("\n".join(lines), file=sys.stderr)
+
+    def write(self, report_path):
+        with self.lock:
+            spans = list(self.spans)
+        if report_path.endswith(".csv"):
+            with atomic_write(report_path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=["phase", "label", "start", "duration", "bytes"])
+                writer.writeheader()
+                writer.writerows(spans)
+        else:
+            with atomic_write(report_path, "w", encoding="utf-8") as f:
+                json.dump({"started": self.start_time, "duration": round(time.time() - self.start_time, 3),
+                           "summary": self.summary(), "spans": spans}, f, indent=2)
+        logging.info("Wrote performance report: " + report_path)
+
+
+class DownloadScheduler:
+    """
+    Governs the transfers of a run, shared by every downloader: limits the number of transfers running at once, in
+    total and per host, caps the bandwidth with a token bucket and adapts the number of concurrent video fragments
+    to the 429/403 responses of the servers.
+    """
+
+    def __init__(self, max_downloads=0, max_bandwidth=0, max_per_host=0, fragments=15):
+        self.semaphore = threading.BoundedSemaphore(max_downloads) if max_downloads > 0 else None
+        self.max_per_host = max_per_host
+        self.host_semaphores = {}
+        self.max_bandwidth = max_bandwidth
+        self.tokens = max_bandwidth
+        self.last_refill = time.monotonic()
+        self.max_fragments = max(1, fragments)
+        self.fragments = self.max_fragments
+        self.successes = 0
+        self.last_throttled = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def transfer(self, url=None):
+        with contextlib.ExitStack() as stack:
+            if self.semaphore is not None:
+                stack.enter_context(self.semaphore)
+            host_semaphore = self.get_host_semaphore(url)
+            if host_semaphore is not None:
+                stack.enter_context(host_semaphore)
+            yield
+
+    def get_host_semaphore(self, url):
+        if self.max_per_host <= 0 or not url:
+            return None
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self.host_semaphores[host]
+
+    def throttle(self, nbytes):
+        """
+        Takes the bytes that were just transferred out of the token bucket, waiting while the bucket is in debt. The
+        bucket holds one second of bandwidth, so short bursts are allowed.
+
+        :param nbytes: int
+            The number of bytes transferred.
+        """
+        if self.max_bandwidth <= 0 or nbytes <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.max_bandwidth, self.tokens + (now - self.last_refill) * self.max_bandwidth)
+            self.last_refill = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.max_bandwidth
+        if wait > 0:
+            time.sleep(wait)
+
+    def report_status(self, status_code):
+        # Halve the fragment concurrency when throttled, then win it back one fragment at a time. The fragments that
+        # were in flight together are throttled together, so a burst of errors only halves it once
+        with self.lock:
+            if status_code in (403, 429):
+                self.successes = 0
+                now = time.monotonic()
+                if self.fragments > 1 and now - self.last_throttled >= THROTTLE_COOLDOWN:
+                    self.last_throttled = now
+                    self.fragments = max(1, self.fragments // 2)
+                    logging.warning("Server answered " + str(status_code) + ", lowering concurrent fragments to " +
+                                    str(self.fragments))
+            elif status_code < 400 and self.fragments < self.max_fragments:
+                self.successes += 1
+                if self.successes >= 20:
+                    self.successes = 0
+                    self.fragments += 1
+                    logging.info("Raising concurrent fragments to " + str(self.fragments))
+
+    def report_error(self, error):
+        match = re.search(r"HTTP Error (403|429)", str(error))
+        if match:
+            self.report_status(int(match.group(1)))
+
+
+def fragment_retry_sleep(n):
+    # Back off exponentially between the retries of a fragment, which are mostly rate limits
+    return min(2 ** n, 30)
+
+
+class ScheduledYoutubeDL(yt_dlp.YoutubeDL):
+    """
+    YoutubeDL that reports the errors of the fragments it retries to the scheduler while the video is downloading,
+    instead of only the error it gives up with.
+    """
+
+    def __init__(self, params, scheduler):
+        self.scheduler = scheduler
+        super().__init__(params)
+
+    def to_screen(self, message, *args, **kwargs):
+        # The retries of fragments and http downloads are only reported as "Got error: HTTP Error 429: ..." messages
+        if "Got error" in message:
+            self.scheduler.report_error(message)
+        return super().to_screen(message, *args, **kwargs)
+
+
 class TeachableDownloader:
-    def __init__(self, verbose_arg=False, complete_lecture_arg=False, user_agent_arg=None, timeout_arg=10):
-        self.driver = Driver(uc=True, headed=True)
+    def __init__(self, verbose_arg=False, complete_lecture_arg=False, user_agent_arg=None, timeout_arg=10,
+                 workers_arg=0, http_resolve_arg=False, fast_remux_arg=False, postprocess_workers_arg=2,
+                 browsers_arg=1, scheduler_arg=None, headless_arg=False, sync_arg=False, perf_arg=None,
+                 perf_report_arg=None, blob_store_arg=None, snapshot_format_arg="html", session_cache_arg=None,
+                 lecture_media_workers_arg=4, prefetch_arg=0):
+        self.session_cache = session_cache_arg
+        self.session_account = None
+        self.perf = perf_arg if perf_arg is not None else PerformanceReport()
+        # Clones and the benchmark share the report of their owner, which prints the summary once
+        self.owns_perf = perf_arg is None
+        self.perf_report = perf_report_arg
+        self.headless = headless_arg
+        self.headless_crawl = headless_arg
+        with self.perf.span("browser_start"):
+            self.driver = self.start_driver(headless_arg)
         self.headers = {
             "User-Agent": user_agent_arg,
             "Origin": "https://player.hotmart.com",
@@ -58,10 +1449,70 @@ class TeachableDownloader:
         self.verbose = verbose_arg
         self._complete_lecture = complete_lecture_arg
         self.global_timeout = timeout_arg
+        self.workers = workers_arg
+        self.prefetch = prefetch_arg
+        self.browsers = browsers_arg
+        self.scheduler = scheduler_arg if scheduler_arg is not None else DownloadScheduler()
+        self.manifest = None
+        self.sync = sync_arg
+        self.completion_queue = None
+        self.http_resolve = http_resolve_arg
+        self.blob_store = blob_store_arg
+        self.snapshot_format = snapshot_format_arg
+        self.snapshots = None
+        self.session = create_session(headers=self.headers, pool_size=max(10, workers_arg),
+                                      on_status=self.scheduler.report_status)
+        self.session.hooks["response"].append(self.on_http_response)
+        self.job_lock = threading.Lock()
+        self.media_info_cache = {}
+        self.media_info_lock = threading.Lock()
+        self.postprocess_pool = None
+        self.postprocess_futures = []
+        self.fast_remux = fast_remux_arg
+        self.postprocess_workers = postprocess_workers_arg
+        self.lecture_media_workers = lecture_media_workers_arg
+        if fast_remux_arg:
+            if shutil.which("ffmpeg") and shutil.which("ffprobe"):
+                self.postprocess_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=postprocess_workers_arg, thread_name_prefix="postprocess")
+            else:
+                logging.warning("ffmpeg or ffprobe not found, fast remux is disabled")
+
+    def on_http_response(self, response, *args, **kwargs):
+        self.scheduler.report_status(response.status_code)
+
+    def start_driver(self, headless):
+        if not headless:
+            return Driver(uc=True, headed=True)
+
+        driver = Driver(uc=True, headless=True, block_images=True)
+        # Only the html of the pages is used, skip loading the heavy assets and trackers
+        try:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+        except Exception as e:
+            logging.warning("Could not block assets in the browser: " + str(e))
+        return driver
+
+    def switch_to_headed(self):
+        """
+        Restarts a headless browser in headed mode for steps that need the user, keeping its cookies and page.
+        """
+        if not self.headless:
+            return
+
+        logging.warning("User interaction needed, restarting the browser in headed mode")
+        current_url = self.driver.current_url
+        cookies = self.driver.get_cookies()
+        self.driver.quit()
+        self.headless = False
+        self.driver = self.start_driver(headless=False)
+        self.load_cookies(cookies, current_url)
+        self.driver.get(current_url)
 
     def check_elem_exists(self, by, selector, timeout):
         try:
-            WebDriverWait(self.driver, timeout=self.global_timeout).until(
+            WebDriverWait(self.driver, timeout=timeout).until(
                 EC.presence_of_element_located((by, selector))
             )
         except NoSuchElementException:
@@ -77,8 +1528,12 @@ class TeachableDownloader:
         if self.driver.capabilities["browserVersion"].split(".")[0] < "115":
             return
         logging.info("Bypassing cloudflare")
-        time.sleep(1)
         if self.check_elem_exists(By.ID, "challenge-stage", timeout=self.global_timeout):
+            if self.headless:
+                self.switch_to_headed()
+                if not self.check_elem_exists(By.ID, "challenge-stage", timeout=self.global_timeout):
+                    logging.info("No need to bypass cloudflare")
+                    return
             try:
                 self.driver.find_element(
                     By.ID, "challenge-stage"
@@ -107,7 +1562,9 @@ class TeachableDownloader:
     def run(self, course_url, email, password, login_url, man_login_url):
         logging.info("Starting login")
 
-        if man_login_url is None:
+        if self.restore_session(course_url, email):
+            logging.info("Skipping login")
+        elif man_login_url is None:
             # Check if login_url is not set
             if login_url is None:
                 try:
@@ -118,16 +1575,17 @@ class TeachableDownloader:
                 self.driver.get(login_url)
 
             try:
-                self.login(email, password)
+                with self.perf.span("login"):
+                    if self.login(email, password) is not False:
+                        self.save_session()
             except Exception as e:
                 logging.error("Could not login: " + str(e), exc_info=self.verbose)
                 return
         else:
+            self.switch_to_headed()
             self.driver.get(course_url)
-            while self.driver.current_url != man_login_url:
-                time.sleep(3)
-                logging.info("Waiting for user to navigate to url: " + man_login_url)
-                logging.info("Current url: " + self.driver.current_url)
+            self.wait_for_manual_login(man_login_url)
+            self.save_session()
 
         logging.info("Starting download of course: " + course_url)
         try:
@@ -156,7 +1614,10 @@ class TeachableDownloader:
         """
         logging.info("Starting login")
 
-        if man_login_url is None:
+        # The cache is keyed by the school, the login url may be an SSO page on another host
+        if self.restore_session(url_array[0], email):
+            logging.info("Skipping login")
+        elif man_login_url is None:
             # Check if login_url is not set
             if login_url is not None:
                 self.driver.get(login_url)
@@ -165,16 +1626,21 @@ class TeachableDownloader:
                 return
 
             try:
-                self.login(email, password)
+                with self.perf.span("login"):
+                    if self.login(email, password) is not False:
+                        self.save_session()
             except Exception as e:
                 logging.error("Could not login: " + str(e), exc_info=self.verbose)
                 return
         else:
+            self.switch_to_headed()
             self.driver.get(url_array[0])
-            while self.driver.current_url != man_login_url:
-                time.sleep(3)
-                logging.info("Waiting for user to navigate to url: " + man_login_url)
-                logging.info("Current url: " + self.driver.current_url)
+            self.wait_for_manual_login(man_login_url)
+            self.save_session()
+
+        if self.browsers > 1 and len(url_array) > 1:
+            self.run_batch_parallel(url_array)
+            return
 
         logging.info("Running batch download of courses ")
         for url in url_array:
@@ -183,6 +1649,169 @@ class TeachableDownloader:
             except Exception as e:
                 logging.error("Could not download course: " + url + " cause: " + str(e))
 
+    def run_batch_parallel(self, url_array):
+        """
+        Downloads the courses with several browser sessions at once. The extra sessions are logged in with the
+        cookies of this one and every session takes the next course from a shared queue. All sessions share the
+        download scheduler, so the concurrency limits apply to the whole batch.
+
+        :param url_array: List[str]
+            An array of URLs pointing to the courses that need to be downloaded.
+        :return: None
+        """
+        browsers = min(self.browsers, len(url_array))
+        logging.info("Running batch download of courses with " + str(browsers) + " browsers")
+        downloaders = [self]
+        for _ in range(browsers - 1):
+            try:
+                downloader = self.clone()
+                self.copy_cookies_to(downloader, url_array[0])
+                downloaders.append(downloader)
+            except Exception as e:
+                logging.error("Could not start browser: " + str(e), exc_info=self.verbose)
+
+        courses = queue.Queue()
+        for url in url_array:
+            courses.put(url)
+
+        threads = []
+        for i, downloader in enumerate(downloaders):
+            thread = threading.Thread(target=downloader.download_course_queue, args=(courses,),
+                                      name="browser-" + str(i))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        for downloader in downloaders[1:]:
+            downloader.clean_up()
+
+    def download_course_queue(self, courses):
+        while True:
+            try:
+                url = courses.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.pick_course_downloader(url)
+            except Exception as e:
+                logging.error("Could not download course: " + url + " cause: " + str(e))
+
+    def clone(self):
+        return TeachableDownloader(verbose_arg=self.verbose, complete_lecture_arg=self._complete_lecture,
+                                   user_agent_arg=self.headers["User-Agent"], timeout_arg=self.global_timeout,
+                                   workers_arg=self.workers, http_resolve_arg=self.http_resolve,
+                                   fast_remux_arg=self.fast_remux, postprocess_workers_arg=self.postprocess_workers,
+                                   scheduler_arg=self.scheduler, headless_arg=self.headless_crawl, sync_arg=self.sync,
+                                   perf_arg=self.perf, blob_store_arg=self.blob_store,
+                                   snapshot_format_arg=self.snapshot_format,
+                                   session_cache_arg=self.session_cache,
+                                   lecture_media_workers_arg=self.lecture_media_workers, prefetch_arg=self.prefetch)
+
+    def copy_cookies_to(self, downloader, url):
+        downloader.load_cookies(self.driver.get_cookies(), url)
+
+    def load_cookies(self, cookies, url):
+        # Cookies can only be added for the domain of the page the browser is on
+        parsed_url = urlparse(url)
+        self.driver.get(urlunparse((parsed_url.scheme, parsed_url.netloc, "/", "", "", "")))
+        for cookie in cookies:
+            cookie = {key: value for key, value in cookie.items()
+                      if key in ("name", "value", "domain", "path", "secure", "httpOnly", "expiry", "sameSite")}
+            try:
+                self.driver.add_cookie(cookie)
+            except Exception as e:
+                logging.debug("Could not copy cookie " + cookie["name"] + ": " + str(e))
+
+    def restore_session(self, url, account):
+        """
+        Restores the cached session of the school of the url and account, checking it is still logged in with a
+        single request.
+
+        :param url: str
+            A url of the school.
+        :param account: str | None
+            The email of the account, None for manual logins.
+        :return: bool
+            True if a valid session was restored and the login can be skipped.
+        """
+        if self.session_cache is None:
+            return False
+
+        parsed_url = urlparse(url)
+        self.session_account = (parsed_url.netloc, account)
+        cached = self.session_cache.load(parsed_url.netloc, account)
+        if not cached:
+            logging.info("No cached session for " + parsed_url.netloc)
+            return False
+
+        now = time.time()
+        cookies = [cookie for cookie in cached["cookies"] if not cookie.get("expiry") or cookie["expiry"] > now]
+        for cookie in cookies:
+            self.session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"),
+                                     path=cookie.get("path", "/"))
+        if cached.get("user_agent"):
+            self.session.headers["User-Agent"] = cached["user_agent"]
+
+        check_url = urlunparse((parsed_url.scheme, parsed_url.netloc, SESSION_CHECK_PATH, "", "", ""))
+        with self.perf.span("session_check", parsed_url.netloc):
+            valid = self.check_session(check_url, cookies)
+        if not valid:
+            logging.info("Cached session of " + parsed_url.netloc + " expired, logging in again")
+            self.session.cookies.clear()
+            return False
+        logging.info("Restored cached session of " + parsed_url.netloc)
+        return True
+
+    def check_session(self, check_url, cookies):
+        try:
+            response = self.session.get(check_url, headers={"Origin": None, "Referer": None})
+        except Exception as e:
+            logging.debug("Could not check the cached session over http: " + str(e))
+            response = None
+
+        school_host = urlparse(check_url).netloc
+        if response is not None and "challenge-stage" not in response.text:
+            if not response.ok or not is_logged_in_url(response.url, school_host):
+                return False
+            self.load_cookies(cookies, check_url)
+            return True
+
+        # Cloudflare does not let plain http through, check with the browser instead
+        self.load_cookies(cookies, check_url)
+        self.driver.get(check_url)
+        if self.check_elem_exists(By.ID, "challenge-stage", timeout=self.global_timeout):
+            self.bypass_cloudflare()
+        self.wait_for_page_load()
+        return is_logged_in_url(self.driver.current_url, school_host)
+
+    def save_session(self):
+        if self.session_cache is None or self.session_account is None:
+            return
+        try:
+            self.session_cache.save(*self.session_account, {
+                "cookies": self.driver.get_cookies(),
+                "user_agent": self.driver.execute_script("return navigator.userAgent"),
+                "saved": time.time(),
+            })
+            logging.info("Saved session of " + self.session_account[0])
+        except Exception as e:
+            logging.warning("Could not save the session: " + str(e))
+
+    def wait_for_manual_login(self, man_login_url):
+        while True:
+            logging.info("Waiting for user to navigate to url: " + man_login_url)
+            logging.info("Current url: " + self.driver.current_url)
+            try:
+                WebDriverWait(self.driver, timeout=30).until(EC.url_to_be(man_login_url))
+                return
+            except TimeoutException:
+                continue
+
+    def wait_for_page_load(self):
+        WebDriverWait(self.driver, self.global_timeout).until(
+            lambda driver: driver.execute_script("return document.readyState") == "complete")
+
     def construct_sign_in_url(self, course_url):
         parsed_url = urlparse(course_url)
         # Replace the path with '/sign_in'
@@ -232,32 +1861,41 @@ class TeachableDownloader:
         password_element.clear()
         self.driver.execute_script("document.getElementById('password').value='" + password + "'")
 
+        sign_in_url = self.driver.current_url
         commit_element.click()
 
-        # Check for login error due to incorrect credentials
-        logging.debug("Checking for login error")
+        # Wait for whatever the form submission leads to: a redirect, an error message or the new device challenge
+        logging.debug("Waiting for login result")
         try:
-            error_elements = WebDriverWait(self.driver, self.global_timeout).until(
-                EC.presence_of_all_elements_located((By.CSS_SELECTOR, "div.toast, span.text-with-icon"))
-            )
-            for element in error_elements:
-                if "Your email or password is incorrect" in element.text:
-                    logging.error("Login failed: Incorrect email or password.")
-                    return False
+            WebDriverWait(self.driver, self.global_timeout).until(EC.any_of(
+                EC.url_changes(sign_in_url),
+                EC.presence_of_element_located((By.CSS_SELECTOR, "div.toast, span.text-with-icon")),
+                EC.presence_of_element_located((By.NAME, "otp_code"))
+            ))
+            self.wait_for_page_load()
         except TimeoutException:
-            # No error message found, continue
-            pass
+            logging.warning("Login did not lead anywhere within the timeout")
+
+        # Check for login error due to incorrect credentials
+        logging.debug("Checking for login error")
+        for element in self.driver.find_elements(By.CSS_SELECTOR, "div.toast, span.text-with-icon"):
+            if "Your email or password is incorrect" in element.text:
+                logging.error("Login failed: Incorrect email or password.")
+                return False
 
         # Check for new device challenge
         # input with name otp_code
-        if self.check_elem_exists(By.NAME, "otp_code", timeout=self.global_timeout):
+        if self.driver.find_elements(By.NAME, "otp_code"):
+            if not sys.stdin.isatty():
+                # Unattended runs would wait forever on the prompt
+                raise Exception("new device challenge needs a code from the email, run once interactively")
+            self.switch_to_headed()
             # wait for user to enter code
             input(
                 "\033[93mWarning: New device challenge\nplease enter the code sent to your email and press enter to "
                 "continue\033[0m"
             )
         logging.info("Logged in, switching to course page")
-        time.sleep(3)
 
     def pick_course_downloader(self, course_url):
         # Check if we are already on the course page
@@ -270,15 +1908,28 @@ class TeachableDownloader:
         WebDriverWait(self.driver, timeout=self.global_timeout).until(
             EC.presence_of_element_located((By.TAG_NAME, 'body')))
 
+        if self.http_resolve or self._complete_lecture:
+            self.sync_session_cookies()
+
         # https://support.teachable.com/hc/en-us/articles/360058715732-Course-Design-Templates
         logging.info("Picking course downloader")
-        if self.driver.find_elements(By.ID, "__next"):
+        with self.perf.span("template_detection", course_url):
+            if self.driver.find_elements(By.ID, "__next"):
+                template = "__next"
+            elif self.driver.find_elements(By.CLASS_NAME, "course-mainbar"):
+                template = "course-mainbar"
+            elif self.driver.find_elements(By.CSS_SELECTOR, ".block__curriculum"):
+                template = ".block__curriculum"
+            else:
+                template = None
+
+        if template == "__next":
             logging.info('Choosing __next format')
             self.download_course_simple(course_url)
-        elif self.driver.find_elements(By.CLASS_NAME, "course-mainbar"):
+        elif template == "course-mainbar":
             logging.info('Choosing course-mainbar format')
             self.download_course_classic(course_url)
-        elif self.driver.find_elements(By.CSS_SELECTOR, ".block__curriculum"):
+        elif template == ".block__curriculum":
             logging.info('Choosing .block__curriculum format')
             self.download_course_colossal(course_url)
         else:
@@ -286,12 +1937,15 @@ class TeachableDownloader:
 
     def download_course_colossal(self, course_url):
         logging.info("Detected block course format")
-        try:
-            logging.info("Getting course title")
-            course_title = WebDriverWait(self.driver, self.global_timeout).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, ".course__title"))
-            ).text
-        except Exception as e:
+        WebDriverWait(self.driver, self.global_timeout).until(
+            EC.presence_of_all_elements_located((By.CSS_SELECTOR, ".block__curriculum__section"))
+        )
+        page_source = self.driver.page_source
+
+        logging.info("Getting course title")
+        soup = make_soup(page_source)
+        course_title = parse_course_title(soup, ".course__title")
+        if not course_title:
             logging.warning("Could not get course title, using tab title instead")
             course_title = self.driver.title
 
@@ -299,63 +1953,25 @@ class TeachableDownloader:
         course_path = create_folder(course_title)
 
         logging.info("Saving course html")
-        try:
-            output_file = os.path.join(course_path, "course.html")
-            with open(output_file, 'w+') as f:
-                f.write(self.driver.page_source)
-        except Exception as e:
-            logging.error("Could not save course html: " + str(e), exc_info=self.verbose)
-
-        # Unhide all elements
-        logging.info("Unhiding all elements")
-        self.driver.execute_script('[...document.querySelectorAll(".hidden")].map(e=>e.classList.remove("hidden"))')
-
-        chapter_idx = 1
-        video_list = []
-        sections = WebDriverWait(self.driver, self.global_timeout).until(
-            EC.presence_of_all_elements_located((By.CSS_SELECTOR, ".block__curriculum__section"))
-        )
-
-        for section in sections:
-            chapter_title = section.find_element(By.CSS_SELECTOR, ".block__curriculum__section__title").text
-            chapter_title = clean_string(chapter_title)
-            chapter_title = "{:02d}-{}".format(chapter_idx, chapter_title)
-            logging.info("Found chapter: " + chapter_title)
-
-            download_path = os.path.join(course_path, chapter_title)
-            os.makedirs(download_path, exist_ok=True)
-
-            chapter_idx += 1
-            idx = 1
-
-            section_items = section.find_elements(By.CSS_SELECTOR, ".block__curriculum__section__list__item__link")
-            for section_item in section_items:
-                lecture_link = section_item.get_attribute("href")
-
-                lecture_title = section_item.find_element(By.CSS_SELECTOR,
-                                                          ".block__curriculum__section__list__item__lecture-name").text
-                lecture_title = clean_string(lecture_title)
-                lecture_title = ''.join(char for char in lecture_title if char in string.printable)
-                logging.info("Found lecture: " + lecture_title)
+        self.save_course_html(page_source, course_path)
 
-                truncated_lecture_title = truncate_title_to_fit_file_name(lecture_title)
-
-                video_entity = {"link": lecture_link, "title": truncated_lecture_title, "idx": idx,
-                                "download_path": download_path}
-                video_list.append(video_entity)
-                idx += 1
-
-        self.download_videos_from_links(video_list)
+        with self.perf.span("curriculum", course_title):
+            sections = parse_curriculum_colossal(soup, self.driver.current_url)
+            video_list = build_video_list(sections, course_path)
+        self.download_videos_from_links(video_list, course_path)
 
     def download_course_classic(self, course_url):
         # self.driver.find_elements(By.CLASS_NAME, "course-mainbar")
         logging.info("Detected _mainbar course format")
-        try:
-            logging.debug("Getting course title")
-            course_title = WebDriverWait(self.driver, self.global_timeout).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, "body > section > div.course-sidebar > div > h2"))
-            ).text
-        except Exception as e:
+        WebDriverWait(self.driver, self.global_timeout).until(
+            EC.presence_of_all_elements_located((By.CSS_SELECTOR, ".course-section"))
+        )
+        page_source = self.driver.page_source
+
+        logging.debug("Getting course title")
+        soup = make_soup(page_source)
+        course_title = parse_course_title(soup, "body > section > div.course-sidebar > div > h2")
+        if not course_title:
             logging.warning("Could not get course title, using tab title instead")
             course_title = self.driver.title
 
@@ -364,91 +1980,35 @@ class TeachableDownloader:
         logging.info("Found course title: " + course_title)
         course_path = create_folder(course_title)
 
-        try:
-            logging.debug("Saving course html")
-            output_file = os.path.join(course_path, "course.html")
-            with open(output_file, 'w+', encoding="utf-8") as f:
-                f.write(self.driver.page_source)
-        except Exception as e:
-            logging.error("Could not save course html: " + str(e), exc_info=self.verbose)
+        logging.debug("Saving course html")
+        self.save_course_html(page_source, course_path)
 
         # Get course image
-
-        try:
-            image_element = self.driver.find_elements(By.CLASS_NAME, "course-image")
+        image_link = parse_image_link(soup, ".course-image", self.driver.current_url)
+        if image_link:
             logging.info("Found course image")
-            image_link = image_element[0].get_attribute("src")
             image_link_hd = re.sub(r"/resize=.+?/", "/", image_link)
             # try to download the image using the modified link first
-            response = requests.get(image_link_hd)
-            if response.ok:
-                # save the image to disk
-                image_path = os.path.join(course_path, "course-image.jpg")
-                with open(image_path, "wb") as f:
-                    f.write(response.content)
-                logging.info("Image downloaded successfully.")
-            else:
+            if not self.download_course_image(image_link_hd, course_path):
                 # try to download the image using the original link
-                response = requests.get(image_link)
-                if response.ok:
-                    # save the image to disk
-                    image_path = os.path.join(course_path, "course-image.jpg")
-                    with open(image_path, "wb") as f:
-                        f.write(response.content)
-                    logging.info("Image downloaded successfully.")
-                else:
-                    # print a message indicating that the image download failed
-                    logging.warning("Failed to download image.")
-        except Exception as e:
-            logging.warning("Could not find course image: " + str(e))
-            pass
-
-        chapter_idx = 1
-        video_list = []
-        sections = WebDriverWait(self.driver, 10).until(
-            EC.presence_of_all_elements_located((By.CSS_SELECTOR, ".course-section"))
-        )
-        for section in sections:
-            chapter_title = section.find_element(By.CSS_SELECTOR, ".section-title").text
-            chapter_title = clean_string(chapter_title)
-            chapter_title = chapter_title = "{:02d}-{}".format(chapter_idx, chapter_title)
-            logging.info("Found chapter: " + chapter_title)
-
-            download_path = os.path.join(course_path, chapter_title)
-            os.makedirs(download_path, exist_ok=True)
-
-            chapter_idx += 1
-            idx = 1
-
-            section_items = section.find_elements(By.CSS_SELECTOR, ".section-item")
-            for section_item in section_items:
-                lecture_link = section_item.find_element(By.CLASS_NAME, "item").get_attribute("href")
-
-                lecture_title = section_item.find_element(By.CLASS_NAME, "lecture-name").text
-                lecture_title = clean_string(lecture_title)
-                logging.info("Found lecture: " + lecture_title)
-
-                truncated_lecture_title = truncate_title_to_fit_file_name(lecture_title)
-
-                video_entity = {"link": lecture_link, "title": truncated_lecture_title, "idx": idx,
-                                "download_path": download_path}
-                video_list.append(video_entity)
-                idx += 1
+                self.download_course_image(image_link, course_path)
+        else:
+            logging.warning("Could not find course image")
 
-        self.download_videos_from_links(video_list)
+        with self.perf.span("curriculum", course_title):
+            sections = parse_curriculum_classic(soup, self.driver.current_url)
+            video_list = build_video_list(sections, course_path)
+        self.download_videos_from_links(video_list, course_path)
 
     def get_course_title_next(self, course_url):
         if self.driver.current_url != course_url:
             self.driver.get(course_url)
 
-        wrap = WebDriverWait(self.driver, self.global_timeout).until(
+        WebDriverWait(self.driver, self.global_timeout).until(
             EC.presence_of_element_located((By.CSS_SELECTOR, ".wrap")))
-        heading = WebDriverWait(self.driver, self.global_timeout).until(
+        WebDriverWait(self.driver, self.global_timeout).until(
             EC.presence_of_element_located((By.CSS_SELECTOR, ".heading")))
-        course_title = heading.text
-
-        course_title = clean_string(course_title)
-        return course_title
+        return clean_string(parse_course_title(self.driver.page_source, ".heading"))
 
     def download_course_simple(self, course_url):
         self.driver.implicitly_wait(2)
@@ -457,147 +2017,589 @@ class TeachableDownloader:
         logging.info("Found course title: " + course_title)
         course_path = create_folder(course_title)
 
-        output_file = os.path.join(course_path, "course.html")
+        page_source = self.driver.page_source
+        self.save_course_html(page_source, course_path)
+        soup = make_soup(page_source)
+
+        # Download course image
+        logging.info("Downloading course image")
+        image_link = parse_image_link(soup,
+                                      "#__next > div > div > div:nth-of-type(2) > div > div:nth-of-type(1) > img",
+                                      self.driver.current_url)
+        if image_link:
+            logging.info("Found course image")
+            self.download_course_image(image_link, course_path)
+        else:
+            logging.warning("Could not find course image")
+
+        with self.perf.span("curriculum", course_title):
+            sections = parse_curriculum_simple(soup, self.driver.current_url)
+            video_list = build_video_list(sections, course_path)
+        self.download_videos_from_links(video_list, course_path)
+
+    def save_course_html(self, page_source, course_path):
+        # Every course starts by saving its page, the lecture snapshots go through the same writer
+        self.snapshots = SnapshotWriter(course_path, self.snapshot_format)
         try:
-            with open(output_file, 'w+', encoding='utf-8') as f:
-                f.write(self.driver.page_source)
+            self.snapshots.write(page_source, os.path.join(course_path, "course.html"))
         except Exception as e:
             logging.error("Could not save course html: " + str(e), exc_info=self.verbose)
 
-        # Download course image
+    def download_course_image(self, image_link, course_path):
+        image_path = os.path.join(course_path, "course-image.jpg")
+        if self.sync and os.path.isfile(image_path):
+            logging.info("Skipping existing course image")
+            return True
+
+        if self.blob_store is not None:
+            entry = self.blob_store.find(image_link)
+            if entry is not None:
+                self.blob_store.link(entry, image_path)
+                logging.info("Linked course image from the blob store")
+                return True
+
         try:
-            logging.info("Downloading course image")
-            image_element = self.driver.find_element(By.XPATH, "//*[@id=\"__next\"]/div/div/div[2]/div/div[1]/img")
-            logging.info("Found course image")
-            image_link = image_element.get_attribute("src")
-            # Save image
-            image_path = os.path.join(course_path, "course-image.jpg")
-            # send a GET request to the image link
+            with self.scheduler.transfer(image_link):
+                response = self.session.get(image_link)
+                self.scheduler.throttle(len(response.content))
+        except Exception as e:
+            logging.warning("Failed to download image: " + str(e))
+            return False
+        if not response.ok:
+            logging.warning("Failed to download image.")
+            return False
+
+        # save the image to disk
+        with atomic_write(image_path) as f:
+            f.write(response.content)
+        if self.blob_store is not None:
+            self.blob_store.add(image_path, image_link, response.headers.get("ETag"))
+        logging.info("Image downloaded successfully.")
+        return True
+
+    def download_videos_from_links(self, video_list, course_path):
+        self.manifest = CourseManifest(course_path)
+        if self.sync:
+            self.sync_curriculum(video_list, course_path)
+        save_curriculum_snapshot(video_list, course_path)
+
+        if self._complete_lecture:
+            self.completion_queue = LectureCompletionQueue(self.session, self.on_lecture_completed, self.perf)
+
+        if self.workers > 0 or self.prefetch > 0:
+            self.download_videos_pipelined(video_list)
+        else:
+            chapter_path = None
+            for video in video_list:
+                if video["download_path"] != chapter_path:
+                    # The previous chapter is complete, flush it to disk in one batch
+                    if chapter_path is not None:
+                        output_sync.sync(chapter_path)
+                    chapter_path = video["download_path"]
+                job = self.get_lecture_job(video)
+                if job is None:
+                    continue
+                self.download_lecture_job(job)
+
+        self.wait_for_postprocessing()
+        remove_postprocess_folders(video_list)
+        if self.snapshots is not None:
+            self.snapshots.close()
+        output_sync.sync()
+
+        if self._complete_lecture:
+            # Lectures that could not be completed over http are clicked through in the browser
+            for video in self.completion_queue.close():
+                self.try_complete_lecture(video)
+
+    def sync_curriculum(self, video_list, course_path):
+        """
+        Compares the curriculum with the snapshot of the previous run and moves the files of renamed and reordered
+        lectures to their new names, so they are not downloaded again. New lectures are left to the download, finished
+        lectures are skipped through the manifest.
+
+        :param video_list: List[dict]
+            The lectures as built by the download_course_* methods.
+        :param course_path: str
+            The folder of the course.
+        :return: None
+        """
+        previous = load_curriculum_snapshot(course_path)
+        if previous is None:
+            logging.info("No curriculum snapshot found, downloading the whole course")
+            return
+
+        added, moved, removed = diff_curriculum(previous, video_list)
+        logging.info("Curriculum changes since the last run: " + str(len(added)) + " new, " + str(len(moved)) +
+                     " moved or renamed, " + str(len(removed)) + " removed lectures")
+        for lecture in removed:
+            logging.warning("Lecture removed from the course, keeping its files: " + lecture["title"])
+
+        # Move through a staging folder so lectures that swapped names do not overwrite each other
+        staging_path = os.path.join(course_path, ".sync")
+        staged = []
+        for old, new in moved:
+            old_path = os.path.join(course_path, old["chapter"])
+            if not os.path.isdir(old_path):
+                continue
+            old_prefix = "{:02d}-{}".format(old["idx"], old["title"])
+            new_prefix = "{:02d}-{}".format(new["idx"], new["title"])
+            pattern = re.compile(re.escape(old_prefix) + r"(-\d+)?(\..+)?$")
+            for file_name in os.listdir(old_path):
+                if pattern.match(file_name):
+                    staged_name = str(len(staged)) + "-" + file_name
+                    os.makedirs(staging_path, exist_ok=True)
+                    os.replace(os.path.join(old_path, file_name), os.path.join(staging_path, staged_name))
+                    staged.append((staged_name, os.path.join(new["download_path"],
+                                                             new_prefix + file_name[len(old_prefix):])))
+            logging.info("Moving lecture " + old["chapter"] + "/" + old_prefix + " to " +
+                         os.path.basename(new["download_path"]) + "/" + new_prefix)
+            self.rename_manifest_media(new["link"], old["title"], new["title"], old_prefix, new_prefix)
+
+        for staged_name, new_file in staged:
+            os.replace(os.path.join(staging_path, staged_name), new_file)
+        if staged:
+            os.rmdir(staging_path)
+
+        # Drop the chapter folders that were emptied by renamed or reordered chapters
+        for chapter in set(lecture["chapter"] for lecture in previous):
+            chapter_path = os.path.join(course_path, chapter)
+            if os.path.isdir(chapter_path) and not os.listdir(chapter_path):
+                os.rmdir(chapter_path)
+
+    def rename_manifest_media(self, link, old_title, new_title, old_prefix, new_prefix):
+        media = self.manifest.get(link).get("media")
+        if not media:
+            return
+        for item in media:
+            # Keep the -n suffix of lectures with several videos
+            item["title"] = new_title + item["title"][len(old_title):]
+            if item.get("file", "").startswith(old_prefix):
+                item["file"] = new_prefix + item["file"][len(old_prefix):]
+        self.manifest.update(link, media=media)
+
+    def download_videos_pipelined(self, video_list):
+        """
+        Crawls the lectures with the browser while a pool of workers downloads the resolved media.
+
+        The browser only resolves each lecture into a job (saving the html and collecting the attachment, subtitle
+        and video links), the jobs are put on a queue that is drained by ``self.workers`` download threads, or a
+        single one when only prefetching. With ``self.prefetch`` set the browser resolves at most that many lectures
+        ahead of the downloads, so the media links do not expire in the queue.
+
+        :param video_list: List[dict]
+            The lectures as built by the download_course_* methods.
+        :return: None
+        """
+        jobs = queue.Queue(maxsize=self.prefetch)
+        workers = []
+        for i in range(max(1, self.workers)):
+            worker = threading.Thread(target=self.download_worker, args=(jobs,), name="download-worker-" + str(i),
+                                      daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        try:
+            for video in video_list:
+                job = self.get_lecture_job(video)
+                if job is None:
+                    continue
+                jobs.put(job)
+        finally:
+            for _ in workers:
+                jobs.put(None)
+            logging.info("Waiting for " + str(jobs.qsize()) + " queued downloads to finish")
+            for worker in workers:
+                worker.join()
+
+    def get_lecture_job(self, video):
+        """
+        Returns the download job of a lecture, taken from the manifest when the lecture was already resolved by a
+        previous run so the browser does not have to visit it again.
+
+        :param video: dict
+            The lecture entity with the link, title, idx and download_path keys.
+        :return: dict | None
+            The download job, None if there is nothing left to download for the lecture or it could not be
+            resolved.
+        """
+        record = self.manifest.get(video["link"])
+        if record.get("done"):
+            logging.info("Skipping finished lecture: " + video["title"])
+            return None
+
+        if record.get("resolved") and record.get("html"):
+            logging.info("Resuming lecture from manifest: " + video["title"])
+            return {"link": video["link"], "title": video["title"], "idx": video["idx"],
+                    "download_path": video["download_path"], "attachments": record.get("attachments_list", []),
+                    "attachments_done": record.get("attachments", False), "media": record.get("media", []),
+                    "frames": record.get("frames", len(record.get("media", []))),
+                    "video_file": record.get("video_file", False), "completion": record.get("completion")}
+
+        job = None
+        if self.http_resolve:
+            with self.perf.span("http_resolve", video["title"]):
+                job = self.resolve_lecture_http(video)
+        if job is None:
             try:
-                response = requests.get(image_link)
-                # write the image data to a file
-                with open(image_path, "wb") as f:
-                    f.write(response.content)
-                # print a message indicating that the image was downloaded
-                logging.info("Image downloaded successfully.")
+                job = self.resolve_lecture(video)
             except Exception as e:
-                # print a message indicating that the image download failed
-                logging.warning("Failed to download image:" + str(e))
-        except Exception as e:
-            logging.warning("Could not find course image: " + str(e))
-            pass
+                # Only this lecture is lost, it stays unresolved for the next run
+                logging.error("Could not resolve lecture: " + video["title"] + " cause: " + str(e),
+                              exc_info=self.verbose)
+                return None
 
-        chapter_idx = 0
-        video_list = []
-        slim_sections = self.driver.find_elements(By.CSS_SELECTOR, ".slim-section")
-        for slim_section in slim_sections:
-            chapter_idx += 1
-            bars = slim_section.find_elements(By.CSS_SELECTOR, ".bar")
-            chapter_title = slim_section.find_element(By.CSS_SELECTOR, ".heading").text
-            chapter_title = clean_string(chapter_title)
-            chapter_title = "{:02d}-{}".format(chapter_idx, chapter_title)
-            logging.info("Found chapter: " + chapter_title)
+        self.manifest.update(video["link"], resolved=True, attachments_list=job["attachments"],
+                             media=job["media"], frames=job["frames"], video_file=job["video_file"],
+                             completion=job["completion"])
+        return job
 
+    def download_worker(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
             try:
-                not_available_element = WebDriverWait(slim_section, self.global_timeout).until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, ".drip-tag")))
-                logging.warning('Chapter "%s" not available, skipping', chapter_title)
-                continue
-            except TimeoutException:
-                logging.info("Chapter is available")
-                pass  # Element wasn't found so the chapter is available
-
-            download_path = os.path.join(course_path, chapter_title)
-            os.makedirs(download_path, exist_ok=True)
-
-            idx = 1
-            for bar in bars:
-                video = bar.find_element(By.CSS_SELECTOR, ".text")
-                link = video.get_attribute("href")
-                # Remove new line characters from the title and replace spaces with -
-                title = clean_string(video.text)
-                logging.info("Found lecture: " + title)
-                truncated_title = truncate_title_to_fit_file_name(title)
-                video_entity = {"link": link, "title": truncated_title, "idx": idx, "download_path": download_path}
-                video_list.append(video_entity)
-                idx += 1
-
-        self.download_videos_from_links(video_list)
-
-    def download_videos_from_links(self, video_list):
-        for video in video_list:
+                self.download_lecture_job(job)
+            except Exception as e:
+                logging.error("Could not download lecture: " + job["title"] + " cause: " + str(e),
+                              exc_info=self.verbose)
+
+    def resolve_lecture(self, video):
+        """
+        Navigates to a lecture, saves its html and collects everything that has to be downloaded for it.
+
+        :param video: dict
+            The lecture entity with the link, title, idx and download_path keys.
+        :return: dict
+            The download job of the lecture, flagged with video_file when the video was downloaded as a video
+            attachment.
+        """
+        with self.perf.span("page_load", video["title"]):
             if self.driver.current_url != video["link"]:
                 logging.info("Navigating to lecture: " + video["title"])
                 self.driver.get(video["link"])
-                self.driver.implicitly_wait(self.global_timeout)
-            logging.info("Downloading lecture: " + video["title"])
+            # Look up the optional elements of the lecture right away instead of waiting for each missing one
+            self.driver.implicitly_wait(0)
+            self.wait_for_page_load()
+            self.wait_for_video_frames()
+        logging.info("Resolving lecture: " + video["title"])
+
+        # logging.info("Disabling autoplay")
+        # self.driver.execute_script('var checkbox = document.getElementById("custom-toggle-autoplay");'
+        #                            'if (checkbox.checked) {checkbox.click();}')
+
+        job = {"link": video["link"], "title": video["title"], "idx": video["idx"],
+               "download_path": video["download_path"], "attachments": [], "attachments_done": False, "media": [],
+               "frames": 0, "video_file": False, "completion": None}
+
+        # Everything the downloader needs from the page comes back from a single script
+        page = self.read_lecture_page()
+        logging.debug("Lecture page \"" + (page["heading"] or page["title"]) + "\": " + str(len(page["attachments"])) +
+                      " attachments, " + str(len(page["videoAttachments"])) + " video attachments, " +
+                      str(len(page["frames"])) + " video frames")
 
-            # logging.info("Disabling autoplay")
-            # self.driver.execute_script('var checkbox = document.getElementById("custom-toggle-autoplay");'
-            #                            'if (checkbox.checked) {checkbox.click();}')
+        try:
+            logging.info("Saving html")
+            self.save_webpage_as_html(video["title"], video["idx"], video["download_path"], page["html"])
+            self.manifest.update(video["link"], html=True)
+        except Exception as e:
+            logging.error("Could not save html: " + video["title"] + " cause: " + str(e), exc_info=self.verbose)
 
+        job["attachments"] = page["attachments"]
+        logging.debug("Found " + str(len(job["attachments"])) + " attachments for video: " + video["title"])
+
+        if self._complete_lecture and page["completeButton"]:
+            job["completion"] = get_completion_request(video["link"], page["completeButton"]["courseId"],
+                                                       page["completeButton"]["lectureId"], page["csrf"])
+
+        if page["videoAttachments"]:
             try:
-                logging.info("Saving html")
-                self.save_webpage_as_html(video["title"], video["idx"], video["download_path"])
+                logging.debug("Trying to download video as an attachment")
+                if self.download_video_file(video["title"], video["idx"], video["download_path"]):
+                    # The file attachments are still downloaded with the job, the players are not needed
+                    job["video_file"] = True
+                    return job
             except Exception as e:
-                logging.error("Could not save html: " + video["title"] + " cause: " + str(e), exc_info=self.verbose)
+                logging.debug("Could not download video as an attachment: " + video["title"] + " cause: " + str(e))
 
+        # The players are cross-origin, so each frame is read from inside with a single script
+        frames = page["frames"]
+        # A frame that can not be read leaves the lecture unfinished, instead of done without its video
+        job["frames"] = len(frames)
+        for i, frame in enumerate(frames):
+            link = None
             try:
-                logging.info("Downloading attachments")
-                self.download_attachments(video["link"], video["title"], video["idx"], video["download_path"])
+                logging.info("Reading video frame " + str(i + 1) + " of " + str(len(frames)))
+                with self.perf.span("iframe_extraction", video["title"]):
+                    self.driver.switch_to.frame(frame["index"])
+                    link = WebDriverWait(self.driver, self.global_timeout).until(
+                        lambda driver: driver.execute_script(READ_MEDIA_LINK_SCRIPT))["link"]
             except Exception as e:
-                logging.warning("Could not download attachments: " + video["title"] + " cause: " + str(e))
-            
+                logging.debug("Could not read video frame: " + video["title"] + " cause: " + str(e))
+            finally:
+                self.driver.switch_to.default_content()  # Switch back to main content before the next iteration
+
+            if not link:
+                logging.warning("Could not find video: " + video["title"])
+                continue
+            # Append -n to the video title if there are multiple iframes
+            video_title = video["title"] + ("-" + str(i + 1) if len(frames) > 1 else "")
+            job["media"].append({"link": link, "title": video_title, "video": False, "subtitles": False})
+
+        return job
+
+    def resolve_lecture_http(self, video):
+        """
+        Resolves a lecture over plain HTTP with the cookies of the logged in browser, without rendering the page.
+
+        :param video: dict
+            The lecture entity with the link, title, idx and download_path keys.
+        :return: dict | None
+            The download job of the lecture, None if the lecture has to be resolved with the browser instead.
+        """
+        try:
+            response = self.session.get(video["link"], headers={"Origin": None, "Referer": None})
+        except Exception as e:
+            logging.debug("Could not fetch lecture over http: " + video["title"] + " cause: " + str(e))
+            return None
+
+        if not response.ok or not is_logged_in_url(response.url, urlparse(video["link"]).netloc) or \
+                "challenge-stage" in response.text:
+            logging.debug("Lecture page not available over http: " + video["title"])
+            return None
+
+        soup = make_soup(response.text)
+        if soup.select_one(".lecture-attachment-type-video"):
+            # Video attachments are downloaded by the browser
+            return None
+
+        video_iframes = soup.select("iframe[data-testid^='embed-player']")
+        if not video_iframes:
+            # The players may be added by javascript, or the page is not the lecture, let the browser render it
+            return None
+
+        media = []
+        for i, iframe in enumerate(video_iframes):
             try:
-                logging.debug("Trying to download video as an attachment")
-                if self.download_video_file(video["title"], video["idx"], video["download_path"]):
-                    continue
+                iframe_response = self.session.get(urljoin(response.url, iframe["src"]),
+                                                   headers={"Origin": None, "Referer": response.url})
+                iframe_response.raise_for_status()
+                script_text = make_soup(iframe_response.text).select_one("script#__NEXT_DATA__")
+                json_text = json.loads(script_text.string)
+                link = json_text["props"]["pageProps"]["applicationData"]["mediaAssets"][0]["urlEncrypted"]
+            except Exception as e:
+                logging.debug("Could not resolve video frame over http: " + video["title"] + " cause: " + str(e))
+                return None
+
+            # Append -n to the video title if there are multiple iframes
+            video_title = video["title"] + ("-" + str(i + 1) if len(video_iframes) > 1 else "")
+            media.append({"link": link, "title": video_title, "video": False, "subtitles": False})
+
+        logging.info("Resolved lecture over http: " + video["title"])
+        try:
+            self.save_webpage_as_html(video["title"], video["idx"], video["download_path"], response.text)
+            self.manifest.update(video["link"], html=True)
+        except Exception as e:
+            logging.error("Could not save html: " + video["title"] + " cause: " + str(e), exc_info=self.verbose)
 
+        attachments = []
+        attachment_container = soup.select_one(".lecture-attachment-type-file")
+        if attachment_container:
+            for attachment_link in attachment_container.select("a"):
+                attachments.append({"link": urljoin(response.url, attachment_link.get("href", "")),
+                                    "name": element_text(attachment_link)})
+
+        completion = None
+        complete_button = soup.select_one("#lecture_complete_button")
+        if complete_button:
+            csrf_token = soup.select_one("meta[name=csrf-token]")
+            completion = get_completion_request(response.url, complete_button.get("data-course-id"),
+                                                complete_button.get("data-lecture-id"),
+                                                csrf_token.get("content") if csrf_token else None)
+
+        return {"link": video["link"], "title": video["title"], "idx": video["idx"],
+                "download_path": video["download_path"], "attachments": attachments, "attachments_done": False,
+                "media": media, "frames": len(video_iframes), "video_file": False, "completion": completion}
+
+    def read_lecture_page(self):
+        """
+        Reads the attachments, video attachments, player frames, complete button, csrf token, title and html of the
+        lecture page the browser is on, with a single script instead of a WebDriver call per element.
+
+        :return: dict
+            The values collected by READ_LECTURE_PAGE_SCRIPT.
+        """
+        with self.perf.span("page_extraction"):
+            return self.driver.execute_script(READ_LECTURE_PAGE_SCRIPT)
+
+    def sync_session_cookies(self):
+        """
+        Copies the cookies and user agent of the browser into the http session, so requests are made with the
+        logged in session of the browser.
+        """
+        for cookie in self.driver.get_cookies():
+            self.session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"),
+                                     path=cookie.get("path", "/"))
+        # Cloudflare ties its clearance cookie to the user agent of the browser
+        self.session.headers["User-Agent"] = self.driver.execute_script("return navigator.userAgent")
+        logging.debug("Copied " + str(len(self.session.cookies)) + " browser cookies to the http session")
+
+    def wait_for_video_frames(self):
+        # The player iframes of the next template are rendered after the page load
+        try:
+            WebDriverWait(self.driver, self.global_timeout).until(lambda driver: driver.execute_script(
+                "return document.querySelector(\"iframe[data-testid^='embed-player']\") !== null"
+                " || document.documentElement.innerHTML.indexOf('hotmart') === -1"))
+        except TimeoutException:
+            logging.debug("No video frame showed up on the lecture page")
+
+    def download_lecture_job(self, job):
+        if job["attachments_done"]:
+            logging.info("Skipping finished attachments: " + job["title"])
+        elif job["attachments"]:
+            try:
+                logging.info("Downloading attachments")
+                self.download_attachments(job["attachments"], job["title"], job["idx"], job["download_path"])
+                job["attachments_done"] = True
             except Exception as e:
-                logging.debug("Could not download video as an attachment: " + video["title"] + " cause: " + str(e))
+                logging.warning("Could not download attachments: " + job["title"] + " cause: " + str(e))
+        else:
+            logging.warning("No attachments found for video: " + job["title"])
+            job["attachments_done"] = True
+        self.manifest.update(job["link"], attachments=job["attachments_done"])
+
+        if self.lecture_media_workers > 1 and len(job["media"]) > 1:
+            # Lectures with several players download their videos side by side, within the budget of the lecture
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.lecture_media_workers, len(job["media"])),
+                                                       thread_name_prefix="lecture-media") as pool:
+                futures = {pool.submit(self.download_media, job, media_idx, media): media
+                           for media_idx, media in enumerate(job["media"])}
+            # Errors that escaped download_media would otherwise be dropped with the futures
+            for future, media in futures.items():
+                e = future.exception()
+                if e is not None:
+                    logging.error("Could not download media: " + media["title"] + " cause: " + str(e),
+                                  exc_info=e if self.verbose else None)
+        else:
+            for media_idx, media in enumerate(job["media"]):
+                self.download_media(job, media_idx, media)
 
-            video_iframes = self.driver.find_elements(By.XPATH, "//iframe[starts-with(@data-testid, 'embed-player')]")
+        self.finish_lecture_job(job)
 
-            for i, iframe in enumerate(video_iframes):
-                try:
-                    logging.info("Switching to video frame")
-                    self.driver.switch_to.frame(iframe)
+    def download_media(self, job, media_idx, media):
+        if not media.get("subtitles"):
+            try:
+                logging.info("Downloading subtitle")
+                with self.scheduler.transfer(media["link"]):
+                    complete = self.download_subtitle(media["link"], media["title"], job["idx"],
+                                                      job["download_path"])
+                if complete:
+                    media["subtitles"] = True
+                    self.manifest.update_media(job["link"], media_idx, subtitles=True)
+            except Exception as e:
+                logging.warning("Could not download subtitle: " + media["title"] + " cause: " + str(e))
 
-                    script_text = self.driver.find_element(By.ID, "__NEXT_DATA__")
-                    json_text = json.loads(script_text.get_attribute("innerHTML"))
-                    link = json_text["props"]["pageProps"]["applicationData"]["mediaAssets"][0]["urlEncrypted"]
+        output_file = os.path.join(job["download_path"], "{:02d}-{}.mp4".format(job["idx"], media["title"]))
+        if not media.get("video") and is_video_complete(output_file, media.get("bytes")):
+            # Hashing every existing video would cost more than it saves, only the size is recorded
+            logging.info("Skipping existing video: " + output_file)
+            media["video"] = True
+            self.manifest.update_media(job["link"], media_idx, video=True, file=os.path.basename(output_file),
+                                       bytes=os.path.getsize(output_file))
 
-                    # Append -n to the video title if there are multiple iframes
-                    video_title = video["title"] + ("-" + str(i + 1) if len(video_iframes) > 1 else "")
+        if not media.get("video"):
+            try:
+                logging.info("Downloading video")
+                if self.postprocess_pool is not None:
+                    with self.scheduler.transfer(media["link"]):
+                        future = self.download_video_fast(media["link"], media["title"], job["idx"],
+                                                          job["download_path"])
+                    if future is not None:
+                        media["postprocessing"] = True
+                        future.add_done_callback(lambda f: self.on_video_postprocessed(job, media_idx, f))
+                        self.postprocess_futures.append(future)
+                else:
+                    with self.scheduler.transfer(media["link"]):
+                        output_file = self.download_video(media["link"], media["title"], job["idx"],
+                                                          job["download_path"])
+                    if output_file:
+                        self.record_video(job, media_idx, output_file)
+            except Exception as e:
+                logging.warning("Could not download video: " + media["title"] + " cause: " + str(e))
+
+        with self.media_info_lock:
+            self.media_info_cache.pop(media["link"], None)
+
+    def record_video(self, job, media_idx, output_file):
+        # yt-dlp moved the video into place itself, sync it before the manifest says it is complete
+        fsync_path(output_file)
+        output_sync.add(output_file)
+        job["media"][media_idx]["video"] = True
+        # Resumes only compare the size, hashing would read every video a second time
+        self.manifest.update_media(job["link"], media_idx, video=True, file=os.path.basename(output_file),
+                                   bytes=os.path.getsize(output_file))
+
+    def on_video_postprocessed(self, job, media_idx, future):
+        media = job["media"][media_idx]
+        try:
+            self.record_video(job, media_idx, future.result())
+        except Exception as e:
+            logging.warning("Could not postprocess video: " + media["title"] + " cause: " + str(e))
+        media["postprocessing"] = False
+        self.finish_lecture_job(job)
+
+    def finish_lecture_job(self, job):
+        with self.job_lock:
+            if job.get("done") or any(media.get("postprocessing") for media in job["media"]):
+                # The postprocessing pool finishes the job once the videos are remuxed
+                return
 
-                    try:
-                        logging.info("Downloading subtitle")
-                        self.download_subtitle(link, video_title, video["idx"], video["download_path"])
-                    except Exception as e:
-                        logging.warning("Could not download subtitle: " + video_title + " cause: " + str(e))
+            if job["attachments_done"] and len(job["media"]) == job["frames"] and \
+                    all(media["video"] and media["subtitles"] for media in job["media"]):
+                job["done"] = True
+                self.manifest.update(job["link"], done=True)
+                logging.info("Downloaded video: " + job["title"])
+            else:
+                # The media and attachment links expire, let the next run resolve the lecture again
+                self.manifest.update(job["link"], resolved=False)
 
-                    try:
-                        logging.info("Downloading video")
-                        self.download_video(link, video_title, video["idx"], video["download_path"])
-                    except Exception as e:
-                        logging.warning("Could not download video: " + video_title + " cause: " + str(e))
+        if job.get("done") and self._complete_lecture:
+            # Only lectures that were downloaded completely are marked as complete on the school
+            self.queue_lecture_completion(job)
 
-                    self.driver.switch_to.default_content()  # Switch back to main content before the next iteration
+    def wait_for_postprocessing(self):
+        if self.postprocess_futures:
+            logging.info("Waiting for " + str(len(self.postprocess_futures)) + " videos to be postprocessed")
+            concurrent.futures.wait(self.postprocess_futures)
+            self.postprocess_futures = []
 
-                except Exception as e:
-                    logging.warning("Could not find video: " + video["title"])
-                    continue
+    def queue_lecture_completion(self, job):
+        if self.manifest.get(job["link"]).get("completed"):
+            return
 
-            logging.info("Downloaded video: " + video["title"])
+        if job.get("completion"):
+            self.completion_queue.put(job, job["completion"])
+        else:
+            # The browser is busy crawling, it completes the lecture after the downloads
+            self.completion_queue.defer(job)
 
-            if self._complete_lecture:
-                try:
-                    logging.info("Completing lecture")
-                    self.complete_lecture()
-                except Exception as e:
-                    logging.warning("Could not complete lecture: " + video["title"] + " cause: " + str(e))
+    def on_lecture_completed(self, video):
+        self.manifest.update(video["link"], completed=True)
 
-        return
+    def try_complete_lecture(self, video):
+        if self.manifest.get(video["link"]).get("completed"):
+            return
+
+        try:
+            logging.info("Completing lecture")
+            with self.perf.span("lecture_completion", video["title"]):
+                if self.driver.current_url != video["link"]:
+                    self.driver.get(video["link"])
+                self.complete_lecture()
+            self.manifest.update(video["link"], completed=True)
+        except Exception as e:
+            logging.warning("Could not complete lecture: " + video["title"] + " cause: " + str(e))
 
     def complete_lecture(self):
         # Complete lecture
@@ -606,10 +2608,36 @@ class TeachableDownloader:
         if complete_button:
             logging.info("Found complete button")
             complete_button.click()
+            # The button is replaced once the lecture is marked as complete
+            try:
+                WebDriverWait(self.driver, min(self.global_timeout, COMPLETE_BUTTON_TIMEOUT)).until(
+                    EC.staleness_of(complete_button))
+            except TimeoutException:
+                logging.debug("Complete button did not change after clicking it")
             logging.info("Completed lecture")
-            time.sleep(3)
+
+    def extract_media_info(self, link):
+        """
+        Extracts the info of a media link once and returns a copy of it to every caller, so the subtitle and the
+        video download of a lecture share the same manifest request.
+
+        :param link: str
+            The urlEncrypted link of the video.
+        :return: dict
+            The unprocessed info dict, to be passed to ``YoutubeDL.process_ie_result``.
+        """
+        with self.media_info_lock:
+            info = self.media_info_cache.get(link)
+        if info is None:
+            ydl_opts = {"http_headers": self.headers, "verbose": self.verbose}
+            with self.perf.span("ytdlp_extract", link), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(link, download=False, process=False)
+            with self.media_info_lock:
+                self.media_info_cache[link] = info
+        return copy.deepcopy(info)
 
     def download_video(self, link, title, video_index, output_path):
+        output_file = os.path.join(output_path, "{:02d}-{}.mp4".format(video_index, title))
         ydl_opts = {
             "format": "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
             "merge_output_format": "mp4",
@@ -623,15 +2651,99 @@ class TeachableDownloader:
                 },
             ],
             "http_headers": self.headers,
-            "concurrentfragments": 15,
-            "outtmpl": os.path.join(output_path, "{:02d}-{}.mp4".format(video_index, title)),
+            "concurrent_fragment_downloads": self.scheduler.fragments,
+            # Retry throttled fragments, so their errors reach the scheduler while the video is downloading
+            "fragment_retries": FRAGMENT_RETRIES,
+            "retry_sleep_functions": {"fragment": fragment_retry_sleep},
+            "ratelimit": self.scheduler.max_bandwidth or None,
+            # Resume from the .part file and fragments left by an interrupted download
+            "continuedl": True,
+            "outtmpl": output_file,
             "verbose": self.verbose,
+            **self.ytdlp_hooks(title),
         }
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([link])
+            with ScheduledYoutubeDL(ydl_opts, self.scheduler) as ydl:
+                ydl.process_ie_result(self.extract_media_info(link), download=True)
         except Exception as e:
             logging.error("Could not download video: " + title + " cause: " + str(e))
+            self.scheduler.report_error(e)
+            return None
+        return output_file if os.path.isfile(output_file) else None
+
+    def download_video_fast(self, link, title, video_index, output_path):
+        """
+        Downloads a video without the yt-dlp postprocessors and hands it to the postprocessing pool, which remuxes it
+        and writes the metadata in a single ffmpeg pass while the next video is downloading.
+
+        :return: concurrent.futures.Future | None
+            Resolves to the path of the final video, None if the download failed.
+        """
+        output_file = os.path.join(output_path, "{:02d}-{}.mp4".format(video_index, title))
+        # Keep the unprocessed download out of the way of the complete video checks
+        download_path = os.path.join(output_path, POSTPROCESS_FOLDER)
+        ydl_opts = {
+            "format": "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
+            "merge_output_format": "mp4",
+            "fixup": "never",
+            "http_headers": self.headers,
+            "concurrent_fragment_downloads": self.scheduler.fragments,
+            # Retry throttled fragments, so their errors reach the scheduler while the video is downloading
+            "fragment_retries": FRAGMENT_RETRIES,
+            "retry_sleep_functions": {"fragment": fragment_retry_sleep},
+            "ratelimit": self.scheduler.max_bandwidth or None,
+            "continuedl": True,
+            "outtmpl": os.path.join(download_path, "{:02d}-{}.%(ext)s".format(video_index, title.replace("%", "%%"))),
+            "verbose": self.verbose,
+            **self.ytdlp_hooks(title),
+        }
+        try:
+            with ScheduledYoutubeDL(ydl_opts, self.scheduler) as ydl:
+                info = ydl.process_ie_result(self.extract_media_info(link), download=True)
+                downloaded_file = info["requested_downloads"][0]["filepath"]
+        except Exception as e:
+            logging.error("Could not download video: " + title + " cause: " + str(e))
+            self.scheduler.report_error(e)
+            return None
+
+        metadata = {"title": info.get("title"), "comment": info.get("webpage_url")}
+        return self.postprocess_pool.submit(self.timed_remux_video, downloaded_file, output_file, metadata)
+
+    def timed_remux_video(self, downloaded_file, output_file, metadata):
+        with self.perf.span("postprocess", "remux"):
+            return remux_video(downloaded_file, output_file, metadata)
+
+    def ytdlp_hooks(self, title):
+        # Tells apart the time yt-dlp spends downloading from the time its postprocessors take, and takes the bytes
+        # yt-dlp downloads out of the bandwidth of the scheduler
+        started = {"download": time.perf_counter()}
+        downloaded = {}
+        downloaded_lock = threading.Lock()
+
+        def progress_hook(d):
+            if d["status"] == "downloading":
+                with downloaded_lock:
+                    filename = d.get("filename")
+                    total = d.get("downloaded_bytes") or 0
+                    nbytes = max(0, total - downloaded.get(filename, 0))
+                    downloaded[filename] = max(total, downloaded.get(filename, 0))
+                # Fragments are downloaded on threads of their own, holding one of them back holds its transfer back
+                self.scheduler.throttle(nbytes)
+            elif d["status"] == "finished":
+                self.scheduler.report_status(200)
+                now = time.perf_counter()
+                self.perf.record("video_download", title, now - started["download"],
+                                 d.get("total_bytes") or d.get("downloaded_bytes") or 0)
+                started["download"] = now
+
+        def postprocessor_hook(d):
+            if d["status"] == "started":
+                started[d["postprocessor"]] = time.perf_counter()
+            elif d["status"] == "finished" and d["postprocessor"] in started:
+                self.perf.record("postprocess", d["postprocessor"],
+                                 time.perf_counter() - started.pop(d["postprocessor"]))
+
+        return {"progress_hooks": [progress_hook], "postprocessor_hooks": [postprocessor_hook]}
 
     # This function is needed because yt-dlp subtitle downloader is not working
     def download_subtitle(self, link, title, video_index, output_path):
@@ -650,7 +2762,7 @@ class TeachableDownloader:
             "http_headers": self.headers,
             "allsubtitles": True,
             "subtitleslangs": ["all"],
-            "concurrentfragments": 10,
+            "concurrent_fragment_downloads": self.scheduler.fragments,
             "writesubtitles": True,
             "outtmpl": os.path.join(output_path, title),
             "verbose": self.verbose,
@@ -658,83 +2770,144 @@ class TeachableDownloader:
 
         try:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(link, download=False)
+                info = ydl.process_ie_result(self.extract_media_info(link), download=False)
                 info_json = ydl.sanitize_info(info)
         except Exception as e:
             logging.warning("Could not download subtitle: " + title + " cause: " + str(e))
+            return False
 
         subtitle_links = {}
-        for lang, sub_info in info_json["requested_subtitles"].items():
+        for lang, sub_info in (info_json.get("requested_subtitles") or {}).items():
             subtitle_links[lang] = {"url": sub_info["url"], "ext": sub_info["ext"]}
 
-        # Print the subtitle links and language names
-        req = None
+        # Look up the segments of every missing language first, then fetch all of them at once
+        pending = {}
         for lang, sub in subtitle_links.items():
             subtitle_filename = "{:02d}-{}.{}.{}".format(video_index, title, lang, sub["ext"])
             file_path = os.path.join(output_path, subtitle_filename)
             if os.path.isfile(file_path):
                 logging.info("Skipping existing subtitle: " + subtitle_filename)
-            else:
-                base_url = sub["url"]
+                continue
+            pending[lang] = {"url": sub["url"], "filename": subtitle_filename, "file_path": file_path}
+        if not pending:
+            return True
+
+        complete = True
+        with self.perf.span("subtitle", "{:02d}-{}".format(video_index, title)) as span, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=SUBTITLE_FETCH_WORKERS,
+                                                      thread_name_prefix="subtitle") as pool:
+            playlist_futures = {lang: pool.submit(self.fetch_subtitle_resource, sub["url"])
+                                for lang, sub in pending.items()}
+            segment_futures = {}
+            for lang, future in playlist_futures.items():
                 try:
-                    req = requests.get(sub["url"], headers=self.headers)
+                    playlist = future.result()
                 except Exception as e:
-                    logging.warning("Could not download subtitle: " + title + " cause: " + str(e))
-                relative_path = req.text.split("\n")[5]
-                full_url = urljoin(base_url, relative_path)
+                    logging.warning("Could not download subtitle: " + pending[lang]["filename"] + " cause: " + str(e))
+                    complete = False
+                    continue
+                span["bytes"] += len(playlist)
+                if playlist.lstrip().startswith(b"#EXTM3U"):
+                    segment_urls = parse_m3u8_segments(playlist.decode("utf-8", "replace"), pending[lang]["url"])
+                    segment_futures[lang] = [pool.submit(self.fetch_subtitle_resource, segment_url)
+                                             for segment_url in segment_urls]
+                else:
+                    # Not a playlist, the link points at the subtitle itself
+                    pending[lang]["segments"] = [playlist]
+
+            for lang, sub in pending.items():
                 try:
-                    response = requests.get(full_url, headers=self.headers)
-                    with open(file_path, "wb") as f:
-                        f.write(response.content)
+                    segments = sub.get("segments") or [future.result() for future in segment_futures.get(lang, [])]
                 except Exception as e:
-                    logging.warning("Could not download subtitle: " + title + " cause: " + str(e))
-                logging.info("Downloaded subtitle: " + subtitle_filename)
-                
-    def download_video_file(self, title, video_index, output_path, timeout=-1):
-        video_title = "{:02d}-{}".format(video_index, title)
+                    logging.warning("Could not download subtitle: " + sub["filename"] + " cause: " + str(e))
+                    complete = False
+                    continue
+                if lang in segment_futures:
+                    span["bytes"] += sum(len(segment) for segment in segments)
+                if not segments:
+                    if lang in segment_futures:
+                        logging.warning("Subtitle playlist has no segments: " + sub["filename"])
+                        complete = False
+                    continue
 
-        # Grab the video attachments type video
-        video_attachment = self.driver.find_element(By.CLASS_NAME, "lecture-attachment-type-video")
+                with atomic_write(sub["file_path"], defer=True) as f:
+                    f.write(merge_vtt_segments(segments))
+                logging.info("Downloaded subtitle: " + sub["filename"] + " (" + str(len(segments)) + " segments)")
+        return complete
 
-        if not video_attachment:
-            logging.debug(f"No video attachment found for lecture: {title}")
-            return False
+    def fetch_subtitle_resource(self, url):
+        response = self.session.get(url)
+        response.raise_for_status()
+        self.scheduler.throttle(len(response.content))
+        return response.content
 
-        video_link = video_attachment.find_element(By.TAG_NAME, "a")
+    def download_video_file(self, title, video_index, output_path, timeout=-1, stall_timeout=60):
+        video_title = "{:02d}-{}".format(video_index, title)
 
-        if not video_link:
-            logging.debug(f"No video link found for lecture: {title}")
-            return False
+        # The browser downloads into a folder of its own, the chapter folder is written by the download workers at
+        # the same time
+        download_path = os.path.join(output_path, BROWSER_DOWNLOAD_FOLDER, video_title)
+        shutil.rmtree(download_path, ignore_errors=True)
+        os.makedirs(download_path)
+        try:
+            return self.wait_for_video_file(title, video_title, output_path, download_path, timeout, stall_timeout)
+        finally:
+            shutil.rmtree(download_path, ignore_errors=True)
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.dirname(download_path))
 
+    def wait_for_video_file(self, title, video_title, output_path, download_path, timeout, stall_timeout):
         # Set the download directory for this file
         self.driver.execute_cdp_cmd("Page.setDownloadBehavior", {
             "behavior": "allow",
-            "downloadPath": output_path
+            "downloadPath": download_path
         })
         # Get list of files before download
-        files_before_download = set(os.listdir(output_path))
+        files_before_download = set(os.listdir(download_path))
 
-        # Click the link to trigger download
-        video_link.click()
+        # Click the link of the video attachment to trigger download
+        clicked = self.driver.execute_script(
+            "var link = document.querySelector('.lecture-attachment-type-video a');"
+            "if (link === null) return false; link.click(); return true;")
+        if not clicked:
+            logging.debug(f"No video link found for lecture: {title}")
+            return False
 
-        # Wait for download to complete
+        # Wait for download to complete, giving up when it does not start or stops making progress
         start_time = time.time()
+        last_progress_time = start_time
+        last_size = -1
         while True:
-            files_after_download = set(os.listdir(output_path))
+            directory_mtime = os.stat(download_path).st_mtime_ns
+            files_after_download = set(os.listdir(download_path))
 
             # Find new files
             new_files = files_after_download - files_before_download
 
             if len(new_files) == 1 and not list(new_files)[0].endswith('.crdownload'):
                 break
-            
+
+            if new_files:
+                size = sum(os.path.getsize(os.path.join(download_path, f)) for f in new_files
+                           if os.path.isfile(os.path.join(download_path, f)))
+                if size != last_size:
+                    last_size = size
+                    last_progress_time = time.time()
+
             if timeout > 0 and (time.time() - start_time) > timeout:
                 logging.warning(f"Download timeout for lecture: {title}")
                 return False
-        
-            time.sleep(1)
 
-        latest_file = os.path.join(output_path, list(new_files)[0])
+            # Until the download shows up only wait as long as for an element
+            wait_timeout = stall_timeout if new_files else self.global_timeout
+            if time.time() - last_progress_time > wait_timeout:
+                logging.warning(f"Download of the video file stalled for lecture: {title}")
+                return False
+
+            # Wake up as soon as the download is renamed, or after a second to check its progress
+            wait_for_directory_change(download_path, directory_mtime, timeout=1)
+
+        latest_file = os.path.join(download_path, list(new_files)[0])
                 
         # Determine the file extension
         _, extension = os.path.splitext(latest_file)
@@ -744,47 +2917,56 @@ class TeachableDownloader:
         new_filepath = os.path.join(output_path, new_filename)
         
         # Rename the file
-        os.rename(latest_file, new_filepath)
+        replace_file(latest_file, new_filepath)
         logging.info(f"Downloaded video file {new_filename}")
         return True
     
-    def download_attachments(self, link, title, video_index, output_path):
+    def download_attachments(self, attachments, title, video_index, output_path):
         video_title = "{:02d}-{}".format(video_index, title)
 
-        # Grab the video attachments type file
-        video_attachments = self.driver.find_elements(By.CLASS_NAME, "lecture-attachment-type-file")
-        # Get all links from the video attachments
-
-        if video_attachments:
-            video_links = video_attachments[0].find_elements(By.TAG_NAME, "a")
-
-            output_path = os.path.join(output_path, video_title)
-            os.makedirs(output_path, exist_ok=True)
-
-            # Get href attribute from the first link
-            if video_links:
-                for video_link in video_links:
-                    link = video_link.get_attribute("href")
-                    file_name = video_link.text
-                    logging.info("Downloading attachment: " + file_name + " for video: " + title)
-                    # Download file and save the file in output_path directory
-                    wget.download(link, out=output_path)
-        else:
-            logging.warning("No attachments found for video: " + title)
+        output_path = os.path.join(output_path, video_title)
+        os.makedirs(output_path, exist_ok=True)
+
+        for attachment in attachments:
+            logging.info("Downloading attachment: " + attachment["name"] + " for video: " + title)
+            # Download file and save the file in output_path directory
+            with self.scheduler.transfer(attachment["link"]), \
+                    self.perf.span("attachment", attachment["name"]) as span:
+                if self.blob_store is not None:
+                    file_path = self.blob_store.download(self.session, attachment["link"], output_path,
+                                                         attachment["name"], throttle=self.scheduler.throttle)
+                else:
+                    file_path = download_file(self.session, attachment["link"], output_path, attachment["name"],
+                                              throttle=self.scheduler.throttle)
+                span["bytes"] = os.path.getsize(file_path)
 
-    def save_webpage_as_html(self, title, video_index, output_path):
+    def save_webpage_as_html(self, title, video_index, output_path, page_source=None):
         output_file = os.path.join(output_path, "{:02d}-{}.html".format(video_index, title))
-        with open(output_file, 'w+', encoding='utf-8') as f:
-            f.write(self.driver.page_source)
+        output_file = self.snapshots.write(page_source if page_source is not None else self.driver.page_source,
+                                           output_file)
         logging.info("Saved webpage as html: " + output_file)
 
     def save_webpage_as_pdf(self, title, video_index, output_path):
         output_file_pdf = os.path.join(output_path, "{:02d}-{}.pdf".format(video_index, title))
-        self.driver.save_print_page(output_file_pdf)
+        temp_file_pdf = os.path.join(output_path, "{:02d}-{}.tmp.pdf".format(video_index, title))
+        self.driver.save_print_page(temp_file_pdf)
+        output_sync.defer(temp_file_pdf, output_file_pdf)
         logging.info("Saved webpage as pdf: " + output_file_pdf)
 
     def clean_up(self):
         logging.info("Cleaning up")
+        if self.postprocess_pool is not None:
+            self.postprocess_pool.shutdown(wait=True)
+        if self.owns_perf:
+            self.perf.log_summary()
+        if self.perf_report is not None:
+            try:
+                self.perf.write(self.perf_report)
+            except IOError as e:
+                logging.error("Could not write performance report: " + str(e))
+        output_sync.sync()
+        # Keep the cookies the school refreshed during the run
+        self.save_session()
         self.driver.quit()
         # Delete cookies.txt
         if os.path.exists("cookies.txt"):
@@ -811,6 +2993,14 @@ def read_urls_from_file(file_path):
     return urls
 
 
+def parse_byte_rate(value):
+    # Accepts the byte sizes yt-dlp accepts for its rate limit, like 500K or 4.2M
+    rate = yt_dlp.utils.parse_bytes(value)
+    if rate is None:
+        raise argparse.ArgumentTypeError("invalid byte rate: " + value)
+    return rate
+
+
 def check_required_args(args):
     if args.email and args.password:
         return True
@@ -835,7 +3025,57 @@ if __name__ == "__main__":
     parser.add_argument("--user-agent", required=False, help='User agent to use when downloading videos',
                         default="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
                                 "Chrome/116.0.0.0 Safari/537.36")
-    parser.add_argument("-t", "--timeout", required=False, help='Timeout for selenium driver', default=10)
+    parser.add_argument("-t", "--timeout", required=False, type=int, help='Timeout for selenium driver', default=10)
+    parser.add_argument("-w", "--workers", required=False, type=int, default=0,
+                        help='Number of download workers, when set the browser only resolves lectures while the '
+                             'workers download them (default: 0, download each lecture before visiting the next)')
+    parser.add_argument("--prefetch", required=False, type=int, default=0,
+                        help='Resolve up to this many lectures ahead while the current ones download, with a single '
+                             'download worker unless --workers is set (default: 0, no lookahead limit with --workers)')
+    parser.add_argument("--http-resolve", action='store_true', default=False,
+                        help='Resolve lectures over http with the browser cookies, the browser is only used for the '
+                             'login and for lectures that can not be resolved over http')
+    parser.add_argument("--fast-remux", action='store_true', default=False,
+                        help='Skip the yt-dlp postprocessors and remux the videos in a single ffmpeg pass, only when '
+                             'they are not mp4 already, on a separate pool of postprocessing workers')
+    parser.add_argument("--postprocess-workers", required=False, type=int, default=2,
+                        help='Number of parallel ffmpeg postprocessing jobs when using --fast-remux (default: 2)')
+    parser.add_argument("--lecture-media-workers", required=False, type=int, default=4,
+                        help='Number of videos of a lecture with several players downloaded at once (default: 4)')
+    parser.add_argument("--browsers", required=False, type=int, default=1,
+                        help='Number of browser sessions downloading courses from --file in parallel (default: 1)')
+    parser.add_argument("--max-downloads", required=False, type=int, default=0,
+                        help='Maximum number of transfers running at once across all browsers (default: no limit)')
+    parser.add_argument("--max-bandwidth", required=False, type=parse_byte_rate, default=0,
+                        help='Bandwidth shared by all downloads in bytes per second, e.g. 500K or 4M '
+                             '(default: no limit)')
+    parser.add_argument("--max-per-host", required=False, type=int, default=0,
+                        help='Maximum number of transfers running at once to the same host (default: no limit)')
+    parser.add_argument("--fragments", required=False, type=int, default=15,
+                        help='Number of video fragments downloaded at once, lowered automatically when the server '
+                             'answers 429 or 403 (default: 15)')
+    parser.add_argument("--headless", action='store_true', default=False,
+                        help='Crawl with a headless browser that does not load images, media and trackers, the '
+                             'browser is restarted in headed mode when a captcha, OTP or manual login needs the user')
+    parser.add_argument("--sync", action='store_true', default=False,
+                        help='Only download what changed since the last run, moving the files of renamed and '
+                             'reordered lectures instead of downloading them again')
+    parser.add_argument("--dedup", action='store_true', default=False,
+                        help='Keep attachments and course images once in courses/.blobs and hardlink them into the '
+                             'lectures, files already in the store are not downloaded again. Linked files share '
+                             'their content, edit a copy instead of the linked file')
+    parser.add_argument("--snapshot-format", choices=SnapshotWriter.FORMATS, default="html",
+                        help='Format of the html snapshots of the pages: plain html files, gzip compressed files '
+                             'with the repeated inline scripts stored once per course, or a single zip archive per '
+                             'course (default: html)')
+    parser.add_argument("--session-cache", required=False,
+                        help='Folder of the encrypted session cache, a valid cached session of the school and '
+                             'account skips the login')
+    parser.add_argument("--session-key", required=False, default=os.environ.get("TEACHABLE_DL_SESSION_KEY"),
+                        help='Passphrase encrypting the session cache (default: $TEACHABLE_DL_SESSION_KEY)')
+    parser.add_argument("--perf-report", required=False,
+                        help='Write the timings of every phase of the run to this file (.json or .csv), a summary '
+                             'is printed at the end of every run')
     args = parser.parse_args()
     verbose = False
     if args.verbose == 0:
@@ -848,12 +3088,32 @@ if __name__ == "__main__":
 
     logging.basicConfig(level=log_level, format='%(levelname)s: %(message)s')
 
+    session_cache = None
+    if args.session_cache:
+        if not args.session_key:
+            logging.error("The session cache needs --session-key or TEACHABLE_DL_SESSION_KEY")
+            exit(1)
+        session_cache = SessionCache(os.path.join(args.session_cache, "sessions"), args.session_key)
+
     if not check_required_args(args):
         logging.error("Required arguments are missing. Choose email/password or manual login (man_login_url).")
         exit(1)
 
     downloader = TeachableDownloader(verbose_arg=verbose, complete_lecture_arg=args.complete_lecture,
-                                     user_agent_arg=args.user_agent, timeout_arg=args.timeout)
+                                     user_agent_arg=args.user_agent, timeout_arg=args.timeout,
+                                     workers_arg=args.workers, prefetch_arg=args.prefetch,
+                                     http_resolve_arg=args.http_resolve,
+                                     fast_remux_arg=args.fast_remux, postprocess_workers_arg=args.postprocess_workers,
+                                     browsers_arg=args.browsers, lecture_media_workers_arg=args.lecture_media_workers,
+                                     headless_arg=args.headless, sync_arg=args.sync,
+                                     perf_report_arg=args.perf_report,
+                                     blob_store_arg=BlobStore(os.path.join(os.getcwd(), "courses", ".blobs"))
+                                     if args.dedup else None,
+                                     snapshot_format_arg=args.snapshot_format, session_cache_arg=session_cache,
+                                     scheduler_arg=DownloadScheduler(max_downloads=args.max_downloads,
+                                                                     max_bandwidth=args.max_bandwidth,
+                                                                     max_per_host=args.max_per_host,
+                                                                     fragments=args.fragments))
     if args.file:
         urls = read_urls_from_file(args.file)
         try: